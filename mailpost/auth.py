@@ -6,15 +6,28 @@ Mailpost version 0.1
 
 
 import httplib
+import os
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 import cookielib
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 from poster.streaminghttp import StreamingHTTPHandler,\
     StreamingHTTPRedirectHandler
 
+from mailpost.stats import NullStats
+
 if hasattr(httplib, "HTTPS"):
     from poster.streaminghttp import StreamingHTTPSHandler
 
+#How long (in seconds) a logged in session is used before logging in again
+DEFAULT_SESSION_TTL = 3600
+
 
 def get_handlers():
     """
@@ -27,42 +40,168 @@ def get_handlers():
     return handlers
 
 
-def authenticate(auth_data, request, base_url=None):
-    """
-    Format for auth_data:
-    url: <url to login form>
-    form:
-      username (name of the field in POST): value
-      passwd (name of the field in POST): value
-    """
-    handlers = get_handlers()
+def get_auth_url(auth_data, base_url=None):
     auth_url = auth_data.get('url', None)
     if base_url and not auth_url.startswith('http'):
         auth_url = base_url + auth_url
-        
-    data = {}
-    for key in auth_data['form']:
-        data[key] = auth_data['form'][key]
+    return auth_url
+
+
+class Session(object):
+    """
+    Cookies of a user logged in with a login form and an opener to send
+    requests on behalf of this user.
+    The user is logged in again if a request is answered with 401 or 403,
+    or is redirected to the login page.
+    If `filename` is given, cookies are saved there and are reused by the
+    next run, until `ttl` expires.
+    Duration of logins is recorded in `stats` ('auth.login')
+    """
+
+    def __init__(self, auth_url, form, handlers=None, filename=None,
+                 ttl=DEFAULT_SESSION_TTL, stats=None):
+        self.auth_url = auth_url
+        self.form = form
+        self.filename = filename
+        self.ttl = ttl
+        if stats is None:
+            stats = NullStats()
+        self.stats = stats
+        if handlers is None:
+            handlers = get_handlers()
+        if filename:
+            self.cookiejar = cookielib.LWPCookieJar(filename)
+        else:
+            self.cookiejar = cookielib.CookieJar()
+        # build opener with HTTPCookieProcessor
+        cookies = urllib2.HTTPCookieProcessor(self.cookiejar)
+        self.opener = urllib2.build_opener(urllib2.HTTPRedirectHandler,
+                                           cookies, *handlers)
+        self.logged_in_at = None
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            saved_at = os.path.getmtime(filename)
+            if time.time() - saved_at < ttl:
+                try:
+                    self.cookiejar.load(ignore_discard=True)
+                    self.logged_in_at = saved_at
+                except (IOError, cookielib.LoadError):
+                    pass
+
+    @property
+    def expired(self):
+        return self.logged_in_at is None or \
+               time.time() - self.logged_in_at >= self.ttl
+
+    def login(self):
+        started = time.time()
+        try:
+            self._login()
+        finally:
+            self.stats.timing('auth.login', time.time() - started)
 
-    cj = cookielib.CookieJar()
-    # build opener with HTTPCookieProcessor
-    urlopener = urllib2.build_opener(urllib2.HTTPRedirectHandler,
-                                     urllib2.HTTPCookieProcessor(cj),
-                                     *handlers)
+    def _login(self):
+        #setup cookie
+        f = self.opener.open(self.auth_url)
+        f.close()
 
-    urllib2.install_opener(urlopener)
-    #setup cookie
+        params = urllib.urlencode(self.form)
+        txheaders = \
+            {'User-agent': 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'}
+        req = urllib2.Request(self.auth_url, params, txheaders)
 
-    f = urllib2.urlopen(auth_url)
-    f.close()
+        # perform login with params
+        f = self.opener.open(req)
+        f.close()
+        self.logged_in_at = time.time()
+        if self.filename:
+            self.cookiejar.save(ignore_discard=True)
 
-    params = urllib.urlencode(data)
-    txheaders = \
-        {'User-agent': 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'}
-    req = urllib2.Request(auth_url, params, txheaders)
+    def ensure_login(self, stale_since=None):
+        """
+        Log in, unless the session is alive.
+        `stale_since` is the login time of a session that was rejected
+        by the server, so that concurrent requests log in only once
+        """
+        self._lock.acquire()
+        try:
+            if self.expired or (stale_since is not None and
+                                self.logged_in_at == stale_since):
+                self.login()
+            return self.logged_in_at
+        finally:
+            self._lock.release()
 
-    # perform login with params
-    f = urllib2.urlopen(req)
+    def is_login_page(self, response):
+        path = urlparse.urlparse(response.geturl())[2]
+        return path == urlparse.urlparse(self.auth_url)[2]
 
-    f.close()
-    return cj, urlopener
+    def open(self, request):
+        logged_in_at = self.ensure_login()
+        try:
+            response = self.opener.open(request)
+        except urllib2.HTTPError, e:
+            if e.code not in (401, 403):
+                raise
+        else:
+            if not self.is_login_page(response):
+                return response
+        data = request.get_data()
+        if data is not None and not isinstance(data, basestring):
+            if not hasattr(data, 'reset'):
+                raise urllib2.URLError('Session expired and request '
+                                       'body cannot be sent again')
+            data.reset()
+        self.ensure_login(logged_in_at)
+        return self.opener.open(request)
+
+
+class SessionCache(object):
+    """
+    Sessions shared by all the requests with the same login URL and
+    credentials. If `directory` is given, sessions are saved there
+    """
+
+    def __init__(self, handlers=None, directory=None,
+                 ttl=DEFAULT_SESSION_TTL, stats=None):
+        self.handlers = handlers
+        self.directory = directory
+        self.ttl = ttl
+        self.stats = stats
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, auth_data, base_url=None):
+        auth_url = get_auth_url(auth_data, base_url)
+        form = sorted(auth_data['form'].items())
+        key = repr((auth_url, form))
+        self._lock.acquire()
+        try:
+            if key not in self._sessions:
+                filename = None
+                if self.directory:
+                    filename = os.path.join(self.directory,
+                                            sha1(key).hexdigest() + '.lwp')
+                self._sessions[key] = Session(auth_url, dict(form),
+                                              self.handlers, filename,
+                                              self.ttl, self.stats)
+            return self._sessions[key]
+        finally:
+            self._lock.release()
+
+
+def authenticate(auth_data, request, base_url=None, handlers=None):
+    """
+    Format for auth_data:
+    url: <url to login form>
+    form:
+      username (name of the field in POST): value
+      passwd (name of the field in POST): value
+    `handlers` replace the default poster handlers, if given.
+    The opener isn't installed globally, requests should be sent with the
+    returned one
+    """
+    session = Session(get_auth_url(auth_data, base_url),
+                      dict(auth_data['form']), handlers)
+    session.login()
+    return session.cookiejar, session.opener
@@ -0,0 +1,101 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded by number of items and, optionally,
+    by total size of items as measured by `sizeof` function.
+    Size of an item is measured again every time it's accessed,
+    since cached objects may grow (e.g. lazy messages)
+    """
+
+    def __init__(self, max_items=None, max_size=None, sizeof=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items[key] = value
+            self._resize(key, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._items:
+                del self._items[key]
+            self._items[key] = value
+            self._resize(key, value)
+        finally:
+            self._lock.release()
+
+    def resize(self, max_items=None, max_size=None):
+        self._lock.acquire()
+        try:
+            self.max_items = max_items
+            self.max_size = max_size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'items': len(self._items), 'size': self.size}
+
+    def _resize(self, key, value):
+        if self.sizeof:
+            size = self.sizeof(value)
+            self.size += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+        self._evict()
+
+    def _evict(self):
+        #The most recently used item is never evicted, even if it's too big
+        while len(self._items) > 1 and (
+                (self.max_items and len(self._items) > self.max_items) or
+                (self.max_size and self.size > self.max_size)):
+            key, value = self._items.popitem(last=False)
+            self.size -= self._sizes.pop(key, 0)
+        if self.max_items is not None and self.max_items <= 0:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
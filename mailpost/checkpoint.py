@@ -0,0 +1,186 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import sqlite3
+import threading
+from collections import deque
+
+#How often (in processed messages) a checkpoint is written to disk
+DEFAULT_SAVE_EVERY = 50
+
+
+class CheckpointStore(object):
+    """
+    Keeps UIDVALIDITY and the highest processed UID of every mailbox
+    in a sqlite database, so that the next run fetches only new messages.
+    Messages processed after ones that failed are kept as well, so that
+    they aren't processed again when the failed ones are
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                         'mailbox TEXT PRIMARY KEY, '
+                         'uidvalidity TEXT, '
+                         'last_uid INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS done_uids ('
+                         'mailbox TEXT, '
+                         'uid INTEGER, '
+                         'PRIMARY KEY (mailbox, uid))')
+        self._db.commit()
+
+    def get(self, mailbox):
+        """
+        Returns (uidvalidity, last_uid) for the mailbox, or (None, 0)
+        if the mailbox was never processed
+        """
+        self._lock.acquire()
+        try:
+            row = self._db.execute('SELECT uidvalidity, last_uid '
+                                   'FROM checkpoints WHERE mailbox = ?',
+                                   (mailbox,)).fetchone()
+        finally:
+            self._lock.release()
+        if not row:
+            return None, 0
+        return row[0], row[1]
+
+    def get_done(self, mailbox):
+        """
+        Returns the set of UIDs processed above last_uid of the mailbox
+        """
+        self._lock.acquire()
+        try:
+            rows = self._db.execute('SELECT uid FROM done_uids '
+                                    'WHERE mailbox = ?',
+                                    (mailbox,)).fetchall()
+        finally:
+            self._lock.release()
+        return set([row[0] for row in rows])
+
+    def set(self, mailbox, uidvalidity, last_uid, done=()):
+        self._lock.acquire()
+        try:
+            self._db.execute('INSERT OR REPLACE INTO checkpoints '
+                             '(mailbox, uidvalidity, last_uid) '
+                             'VALUES (?, ?, ?)',
+                             (mailbox, uidvalidity, last_uid))
+            self._db.execute('DELETE FROM done_uids WHERE mailbox = ?',
+                             (mailbox,))
+            self._db.executemany('INSERT INTO done_uids (mailbox, uid) '
+                                 'VALUES (?, ?)',
+                                 [(mailbox, uid) for uid in done])
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def checkpoint(self, mailbox, uidvalidity, save_every=DEFAULT_SAVE_EVERY,
+                   before_save=None):
+        return Checkpoint(self, mailbox, uidvalidity, save_every,
+                          before_save)
+
+    def close(self):
+        self._db.close()
+
+
+class Checkpoint(object):
+    """
+    Processing watermark of a single mailbox.
+    Messages are `track`ed in the order they are handed out and marked
+    `done` in any order; `last_uid` only advances past a message once
+    every message before it is done. Messages done above `last_uid`
+    are remembered, so that they are skipped when they are handed out
+    again together with the ones that failed.
+    The stored UIDs are discarded if the mailbox UIDVALIDITY has changed
+    """
+
+    def __init__(self, store, mailbox, uidvalidity,
+                 save_every=DEFAULT_SAVE_EVERY, before_save=None):
+        """
+        The checkpoint is saved every `save_every` done messages, 0 leaves
+        it to `save`. `before_save` is called by `save` once it has taken
+        the messages done so far, before they are stored (e.g. to store
+        flags set by their actions first)
+        """
+        self.store = store
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.save_every = save_every
+        self.before_save = before_save
+        stored_uidvalidity, last_uid = store.get(mailbox)
+        done = store.get_done(mailbox)
+        if stored_uidvalidity != uidvalidity:
+            last_uid = 0
+            done = set()
+        self.last_uid = last_uid
+        self._saved_uid = last_uid
+        self._saved_done = frozenset(done)
+        self._unsaved = 0
+        self._pending = deque()
+        self._done = done
+        self._lock = threading.Lock()
+
+    def track(self, uid):
+        """
+        Returns whether the message is done already (processed in
+        a previous cycle or run), such a message isn't to be processed
+        """
+        self._lock.acquire()
+        try:
+            uid = int(uid)
+            self._pending.append(uid)
+            already_done = uid in self._done
+            self._advance()
+        finally:
+            self._lock.release()
+        return already_done
+
+    def done(self, uid):
+        self._lock.acquire()
+        try:
+            self._done.add(int(uid))
+            self._advance()
+            unsaved = self._unsaved
+        finally:
+            self._lock.release()
+        if self.save_every and unsaved >= self.save_every:
+            self.save()
+
+    def _advance(self):
+        while self._pending and self._pending[0] in self._done:
+            uid = self._pending.popleft()
+            self._done.discard(uid)
+            self.last_uid = max(self.last_uid, uid)
+            self._unsaved += 1
+
+    def reset(self):
+        """
+        Forget messages that were tracked but aren't done (e.g. failed to
+        be posted), they are tracked again when they are handed out again
+        """
+        self._lock.acquire()
+        try:
+            self._pending.clear()
+        finally:
+            self._lock.release()
+
+    def save(self):
+        self._lock.acquire()
+        try:
+            last_uid = self.last_uid
+            done = frozenset(self._done)
+            self._unsaved = 0
+        finally:
+            self._lock.release()
+        if self.before_save:
+            self.before_save()
+        if last_uid != self._saved_uid or done != self._saved_done:
+            self.store.set(self.mailbox, self.uidvalidity, last_uid, done)
+            self._saved_uid = last_uid
+            self._saved_done = done
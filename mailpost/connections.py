@@ -0,0 +1,218 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import httplib
+import socket
+import threading
+import time
+import urllib2
+from urllib import addinfourl
+from cStringIO import StringIO
+
+#How many connections to a single host may be open at the same time
+DEFAULT_MAX_CONNECTIONS = 8
+#Idle connections older than that (in seconds) are not reused
+DEFAULT_IDLE_TIMEOUT = 30
+SEND_BLOCK_SIZE = 64 * 1024
+
+
+class ConnectionPool(object):
+    """
+    Persistent HTTP/1.1 connections keyed by (scheme, host:port).
+    A connection is taken with `get` for a single request and is given back
+    with `put` (to be reused) or `discard` (if it can't be reused).
+    `get` blocks while there are `max_connections` to the host in use
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, key):
+        self._lock.acquire()
+        try:
+            if key not in self._slots:
+                self._slots[key] = threading.Semaphore(self.max_connections)
+            return self._slots[key]
+        finally:
+            self._lock.release()
+
+    def get(self, scheme, host, timeout=None):
+        """
+        Returns (connection, reused)
+        """
+        key = (scheme, host)
+        self._slot(key).acquire()
+        expired = []
+        connection = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, since = idle.pop()
+                if time.time() - since < self.idle_timeout:
+                    connection = candidate
+                    break
+                expired.append(candidate)
+        finally:
+            self._lock.release()
+        for candidate in expired:
+            candidate.close()
+        if connection:
+            return connection, True
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        try:
+            if timeout is None:
+                connection = cls(host)
+            else:
+                connection = cls(host, timeout=timeout)
+        except Exception:
+            self._slot(key).release()
+            raise
+        return connection, False
+
+    def put(self, scheme, host, connection):
+        key = (scheme, host)
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append((connection, time.time()))
+        finally:
+            self._lock.release()
+        self._slot(key).release()
+
+    def discard(self, scheme, host, connection):
+        connection.close()
+        self._slot((scheme, host)).release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection, since in connections:
+                connection.close()
+
+    def open(self, scheme, req):
+        """
+        Send urllib2.Request over a pooled connection.
+        Request body may be a string or an iterable of strings
+        (as produced by poster.encode.multipart_encode).
+        A request that fails on a reused connection (which the server may
+        have closed in the meantime) is sent again over a new one,
+        provided that its body can be rewound
+        """
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        headers.pop('Connection', None)
+        data = req.get_data()
+        while True:
+            connection, reused = self.get(scheme, host, req.timeout)
+            try:
+                connection.putrequest(req.get_method(), req.get_selector(),
+                                      skip_host='Host' in headers,
+                                      skip_accept_encoding=True)
+                for name, value in headers.items():
+                    connection.putheader(name, value)
+                if data is None or isinstance(data, basestring):
+                    connection.endheaders(data)
+                else:
+                    self._send_body(connection, data)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                self.discard(scheme, host, connection)
+                if reused and (data is None or isinstance(data, basestring)
+                               or hasattr(data, 'reset')):
+                    if hasattr(data, 'reset'):
+                        data.reset()
+                    continue
+                raise urllib2.URLError(e)
+            except:
+                self.discard(scheme, host, connection)
+                raise
+            if response.will_close:
+                self.discard(scheme, host, connection)
+            else:
+                self.put(scheme, host, connection)
+            break
+        resp = addinfourl(StringIO(body), response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send_body(self, connection, data):
+        """
+        Send an iterable body in blocks of at least SEND_BLOCK_SIZE bytes,
+        the first one along with the headers. Many small writes would make
+        the request wait for delayed TCP acknowledgements
+        """
+        block = []
+        size = 0
+        first = True
+        for chunk in data:
+            block.append(chunk)
+            size += len(chunk)
+            if size >= SEND_BLOCK_SIZE:
+                if first:
+                    connection.endheaders(''.join(block))
+                    first = False
+                else:
+                    connection.send(''.join(block))
+                block = []
+                size = 0
+        if first:
+            connection.endheaders(''.join(block))
+        elif block:
+            connection.send(''.join(block))
+
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pool.open('http', req)
+
+
+if hasattr(httplib, 'HTTPS'):
+
+    class PooledHTTPSHandler(urllib2.HTTPSHandler):
+
+        def __init__(self, pool):
+            urllib2.HTTPSHandler.__init__(self)
+            self.pool = pool
+
+        def https_open(self, req):
+            return self.pool.open('https', req)
+
+
+def get_handlers(pool):
+    """
+    urllib2 handlers sending requests over connections from the pool
+    """
+    handlers = [PooledHTTPHandler(pool)]
+    if hasattr(httplib, 'HTTPS'):
+        handlers.append(PooledHTTPSHandler(pool))
+    return handlers
@@ -24,17 +24,100 @@ fnmatch(FILENAME, PATTERN) matches according to the local convention.
 fnmatchcase(FILENAME, PATTERN) always takes case in account.
 
 The functions operate by translating the pattern into a regular
-expression.  They cache the compiled regular expressions for speed.
+expression.  They cache the compiled regular expressions for speed,
+up to DEFAULT_CACHE_SIZE least recently used ones (see set_cache_size).
+
+compile(PATTERN) returns a reusable Pattern object.
 
 The function translate(PATTERN) returns a regular expression
 corresponding to PATTERN.  (It does not compile it.)
 """
 
+import os
+import posixpath
 import re
 
-__all__ = ["fnmatch", "fnmatchcase", "translate"]
+from mailpost.cache import LRUCache
+
+__all__ = ["fnmatch", "fnmatchcase", "translate", "compile", "Pattern",
+           "set_cache_size", "cache_info", "purge"]
+
+#How many compiled patterns are kept
+DEFAULT_CACHE_SIZE = 1000
+
+_cache = LRUCache(DEFAULT_CACHE_SIZE)
+
+#normcase on posix is NOP. Optimize it away from matching.
+_normcase = os.path is not posixpath and os.path.normcase or None
+
+
+class Pattern(object):
+    """A compiled shell PATTERN, as returned by compile().
+
+    match(NAME) and filter(NAMES) case-normalize names like fnmatch(),
+    matchcase(NAME) doesn't, like fnmatchcase().
+    """
+
+    def __init__(self, pat):
+        self.pattern = pat
+        self.regex = re.compile(translate(pat))
+        self._match = self.regex.match
+
+    def __repr__(self):
+        return '<Pattern %r>' % self.pattern
+
+    def matchcase(self, name):
+        return self._match(name) is not None
+
+    def match(self, name):
+        if _normcase:
+            name = _normcase(name)
+        return self._match(name) is not None
+
+    __call__ = match
+
+    def filter(self, names):
+        match = self._match
+        if _normcase:
+            return [name for name in names if match(_normcase(name))]
+        return [name for name in names if match(name)]
+
+
+def _compile(pat):
+    pattern = _cache.get(pat)
+    if pattern is None:
+        #Two threads may compile the same pattern, the result is the same
+        pattern = Pattern(pat)
+        _cache.set(pat, pattern)
+    return pattern
+
+
+def compile(pat):
+    """Return a Pattern object for PATTERN.
+
+    Callers matching the same pattern many times should keep the object,
+    instead of looking the pattern up in the cache on every call.
+    """
+    if _normcase:
+        pat = _normcase(pat)
+    return _compile(pat)
+
+
+def set_cache_size(size):
+    """Set how many compiled patterns are kept, 0 disables the cache"""
+    _cache.resize(size)
+
+
+def cache_info():
+    """Return hits, misses and number of compiled patterns in the cache"""
+    info = _cache.info()
+    return {'hits': info['hits'], 'misses': info['misses'],
+            'items': info['items'], 'max_items': _cache.max_items}
+
 
-_cache = {}
+def purge():
+    """Clear the pattern cache"""
+    _cache.clear()
 
 
 def fnmatch(name, pat):
@@ -52,32 +135,15 @@ def fnmatch(name, pat):
     if the operating system requires it.
     If you don't want this, use fnmatchcase(FILENAME, PATTERN).
     """
-    import os
-    name = os.path.normcase(name)
-    pat = os.path.normcase(pat)
-    return fnmatchcase(name, pat)
+    if _normcase:
+        name = _normcase(name)
+        pat = _normcase(pat)
+    return _compile(pat).matchcase(name)
 
 
 def filter(names, pat):
     """Return the subset of the list NAMES that match PAT"""
-    import os
-    import posixpath
-    result = []
-    pat = os.path.normcase(pat)
-    if not pat in _cache:
-        res = translate(pat)
-        _cache[pat] = re.compile(res)
-    match = _cache[pat].match
-    if os.path is posixpath:
-        # normcase on posix is NOP. Optimize it away from the loop.
-        for name in names:
-            if match(name):
-                result.append(name)
-    else:
-        for name in names:
-            if match(os.path.normcase(name)):
-                result.append(name)
-    return result
+    return compile(pat).filter(names)
 
 
 def fnmatchcase(name, pat):
@@ -86,10 +152,7 @@ def fnmatchcase(name, pat):
     This is a version of fnmatch() which doesn't case-normalize
     its arguments.
     """
-    if not pat in _cache:
-        res = translate(pat)
-        _cache[pat] = re.compile(res)
-    return _cache[pat].match(name) is not None
+    return _compile(pat).matchcase(name)
 
 
 def translate(pat):
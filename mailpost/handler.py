@@ -8,12 +8,35 @@ import re
 import urllib
 import urllib2
 import os
-from imap import ImapClient
+import posixpath
+import Queue
+import itertools
+import collections
+import imaplib
+import select
+import socket
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from imap import ImapClient, ParserPool, DEFAULT_CHUNK_SIZE, \
+    DEFAULT_CHUNK_BYTES, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_BYTES, \
+    DEFAULT_IDLE_INTERVAL, DEFAULT_POLL_INTERVAL, DEFAULT_SPOOL_SIZE
 from poster.encode import multipart_encode, MultipartParam
-from poster.streaminghttp import register_openers
 
 from mailpost import fnmatch
 from mailpost import auth
+from mailpost.checkpoint import CheckpointStore
+from mailpost.outbox import Outbox, is_transient, DEFAULT_MAX_ATTEMPTS, \
+    DEFAULT_RETRY_DELAY, DEFAULT_MAX_RETRY_DELAY
+from mailpost.pool import WorkerPool, prefetch, wait_for
+from mailpost.connections import ConnectionPool, get_handlers, \
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_IDLE_TIMEOUT
+from mailpost.ratelimit import Limiter, HostLimits, DEFAULT_MAX_PAUSE
+from mailpost.stats import Stats, NullStats, StatsdExporter, metric_name, \
+    DEFAULT_STATSD_PORT, DEFAULT_STATSD_PREFIX
 
 #TODO: Everything.
 
@@ -35,8 +58,45 @@ DEFAULT_RULE = {
     #Additional request params
     'add_params': {},
     'send_files': True,
+    #Encoding of the request body: 'multipart', 'json' or 'ndjson'
+    #(a line of JSON per message), messages with attachments to send
+    #are always posted as multipart
+    'format': 'multipart',
     #Backend-specific actions
     'actions': [],
+    #Run actions only after the message was posted successfully
+    #or queued in the outbox to be retried
+    'defer_actions': False,
+    #Name of the rule in stats, its position by default
+    'name': None,
+    #Limits of requests sent by the rule: requests per second,
+    #how many of them may be sent at once and at the same time
+    'rate_limit': None,
+    'burst': None,
+    'max_in_flight': None,
+    #Post up to that many messages in a single request,
+    #the batch is sent earlier once its messages take `batch_bytes`
+    #or the first of them has waited for `batch_wait` seconds
+    'batch_size': None,
+    'batch_bytes': None,
+    'batch_wait': None,
+}
+
+#Longest pause (in seconds) between attempts to reconnect in daemon mode
+DEFAULT_MAX_BACKOFF = 300
+#How many mailboxes are processed at the same time
+DEFAULT_IMAP_CONNECTIONS = 4
+#Message params that need bodies or attachments of a message
+PART_PARAMS = ['body', 'text_bodies', 'html_bodies', 'attachments']
+#How many matched messages are parsed ahead of the one being posted
+#(with 'parse_processes' option), or have their parts downloaded together
+#(with 'lazy' option)
+PARSE_AHEAD = 16
+#Content types of 'format' option, multipart is encoded by poster
+CONTENT_TYPES = {
+    'multipart': None,
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
 }
 
 
@@ -44,95 +104,833 @@ class ConfigurationError(Exception):
     pass
 
 
+class BatchItemError(Exception):
+    """
+    The result of a message posted in a batch that the receiver
+    didn't accept, `item` is what it answered for the message
+    """
+
+    def __init__(self, item):
+        Exception.__init__(self, 'Message was rejected: %r' % (item,))
+        self.item = item
+
+
+def split_result(result, count):
+    """
+    Results of `count` messages posted in a single request.
+    The receiver may answer with a JSON list of results in the order of
+    messages, an item that is false or has 'error' key means the message
+    wasn't accepted (BatchItemError). Any other answer (or URLError)
+    is the result of every message
+    """
+    if isinstance(result, Exception):
+        return [result] * count
+    try:
+        items = json.loads(result)
+    except ValueError:
+        return [result] * count
+    if not isinstance(items, list) or len(items) != count:
+        return [result] * count
+    results = []
+    for item in items:
+        if not item or isinstance(item, dict) and item.get('error', None):
+            results.append(BatchItemError(item))
+        else:
+            results.append(item)
+    return results
+
+
+def compile_patterns(patterns, syntax='glob'):
+    """
+    Combine glob patterns of a condition into a single regular expression,
+    returns a function matching a value against any of them.
+    Regular expressions are compiled separately: inline flags and
+    backreferences of one of them would change the others if combined
+    """
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    elif type(patterns) not in [list, tuple]:
+        raise ConfigurationError(\
+                    "Pattern should be string or list, not %s" %\
+                                 type(patterns))
+    if syntax == 'regexp':
+        matches = [re.compile(pattern).match for pattern in patterns]
+        normcase = None
+    else:
+        expressions = [fnmatch.translate(os.path.normcase(pattern))
+                       for pattern in patterns]
+        #normcase on posix is NOP. Optimize it away from matching.
+        normcase = os.path is not posixpath and os.path.normcase or None
+        try:
+            matches = [re.compile('|'.join(['(?:%s)' % expression
+                                            for expression
+                                            in expressions])).match]
+        except (re.error, AssertionError):
+            #E.g. too many patterns for a single expression
+            matches = [re.compile(expression).match
+                       for expression in expressions]
+    if len(matches) == 1 and not normcase:
+        match = matches[0]
+        return lambda value: match(value) is not None
+
+    def match_any(value):
+        if normcase:
+            value = normcase(value)
+        for match in matches:
+            if match(value) is not None:
+                return True
+        return False
+    return match_any
+
+
+class Rule(object):
+    """
+    A rule from configuration compiled for matching messages:
+    options are merged with DEFAULT_RULE, URL is joined with base URL
+    and patterns of every condition are combined into a single expression.
+    Options are available as items, like in a dict
+    """
+
+    def __init__(self, msg_rule, base_url=None):
+        try:
+            url = msg_rule['url']
+        except KeyError:
+            raise ConfigurationError('URL is required')
+        if base_url:
+            url = base_url.rstrip('/') + '/' + url.lstrip('/')
+        self.url = url
+        options = DEFAULT_RULE.copy()
+        options.update(msg_rule)
+        if options['format'] not in CONTENT_TYPES:
+            raise ConfigurationError("Unknown format: %s" % options['format'])
+        self._options = options
+        self.conditions = tuple([(key, compile_patterns(patterns,
+                                                        options['syntax']))
+                                 for key, patterns
+                                 in options['conditions'].items()])
+        #Whether bodies or attachments of matched messages are posted
+        self.uses_parts = bool(options['send_files'] or
+                               set(options['msg_params']) &
+                               set(PART_PARAMS))
+        self.limiter = None
+        if options['rate_limit'] or options['max_in_flight']:
+            self.limiter = Limiter(options['rate_limit'], options['burst'],
+                                   options['max_in_flight'])
+
+    def __getitem__(self, name):
+        return self._options[name]
+
+    def __contains__(self, name):
+        return name in self._options
+
+    def get(self, name, default=None):
+        return self._options.get(name, default)
+
+    def keys(self):
+        return self._options.keys()
+
+    def match(self, message):
+        for key, match in self.conditions:
+            value = message.get(key, None)
+            if not value:
+                value = getattr(message, key, None)
+            if not value or not match(value):
+                return False
+        return True
+
+
+def split_literal(pattern):
+    """
+    Returns ('exact', text) for a glob pattern without wildcards,
+    ('suffix', text) for a pattern like '*@example.com',
+    None for any other pattern
+    """
+    kind = 'exact'
+    if pattern.startswith('*'):
+        kind = 'suffix'
+        pattern = pattern[1:]
+    text = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c in '*?[':
+            return None
+        if c == '\\' and i + 1 < n:
+            i = i + 1
+            c = pattern[i]
+        text.append(c)
+        i = i + 1
+    return kind, ''.join(text)
+
+
+class RuleIndex(object):
+    """
+    Narrows down the rules that may match a message.
+    A rule is indexed by one of its glob conditions, if every pattern of
+    the condition is either an exact value (hash table lookup) or a suffix
+    like '*@example.com' (lookup in a trie of reversed suffixes).
+    Rules that can't be indexed are always candidates.
+    Candidates are returned in the order of rules, so that the first
+    matching rule still wins
+    """
+
+    def __init__(self, rules):
+        self.fallback = []
+        self.exact = {}
+        self.suffixes = {}
+        #normcase on posix is NOP. Optimize it away from lookups.
+        self.normcase = os.path is not posixpath and os.path.normcase or None
+        for position, rule in enumerate(rules):
+            indexed = self._indexable(rule)
+            if not indexed:
+                self.fallback.append(position)
+                continue
+            key, literals = indexed
+            for kind, text in literals:
+                if kind == 'exact':
+                    self.exact.setdefault(key, {}).setdefault(text, [])\
+                                                 .append(position)
+                else:
+                    node = self.suffixes.setdefault(key, {})
+                    for c in reversed(text):
+                        node = node.setdefault(c, {})
+                    node.setdefault(None, []).append(position)
+        self.keys = sorted(set(self.exact.keys() + self.suffixes.keys()))
+
+    def _indexable(self, rule):
+        if rule['syntax'] == 'regexp':
+            return None
+        for key, patterns in sorted(rule['conditions'].items()):
+            if isinstance(patterns, basestring):
+                patterns = [patterns]
+            literals = [split_literal(os.path.normcase(pattern))
+                        for pattern in patterns]
+            if literals and None not in literals:
+                return key, literals
+        return None
+
+    def candidates(self, message):
+        if not self.keys:
+            return self.fallback
+        positions = set(self.fallback)
+        for key in self.keys:
+            value = message.get(key, None)
+            if not value:
+                value = getattr(message, key, None)
+            if not value:
+                continue
+            if self.normcase:
+                value = self.normcase(value)
+            positions.update(self.exact.get(key, {}).get(value, []))
+            node = self.suffixes.get(key)
+            i = len(value)
+            while node:
+                positions.update(node.get(None, []))
+                i = i - 1
+                if i < 0:
+                    break
+                node = node.get(value[i])
+        return sorted(positions)
+
+
+class Batch(object):
+    """
+    Messages matched by a rule with 'batch_size' option, with their
+    params and attachments, waiting to be posted in a single request
+    """
+
+    def __init__(self, url, options):
+        self.url = url
+        self.options = options
+        self.messages = []
+        self.params = []
+        self.files = []
+        self.size = 0
+        self.started = time.time()
+
+    def add(self, message, params, files):
+        self.messages.append(message)
+        self.params.append(params)
+        self.files.extend(files)
+        for value in params.values():
+            if isinstance(value, basestring):
+                self.size += len(value)
+        for file_param in files:
+            self.size += file_param.filesize
+
+    def ready(self, now=None):
+        """
+        Whether the batch is full or has waited long enough
+        """
+        options = self.options
+        if len(self.messages) >= options['batch_size']:
+            return True
+        if options['batch_bytes'] and self.size >= options['batch_bytes']:
+            return True
+        if now is None:
+            now = time.time()
+        return bool(options['batch_wait'] and
+                    now - self.started >= options['batch_wait'])
+
+
 class Mapper(object):
 
-    def __init__(self, mappings=None, base_url=None):
+    def __init__(self, mappings=None, base_url=None, workers=0,
+                 connections=None, sessions=None, outbox=None, stats=None,
+                 limits=None):
+        """
+        If `workers` is given, messages are posted by a pool of that many
+        threads. A rule may have its own pool with 'workers' option.
+        `connections` is a connections.ConnectionPool to send requests with,
+        by default a new one is created.
+        `sessions` is an auth.SessionCache for rules with 'auth' option.
+        Requests that failed with a transient error are queued in
+        `outbox` (an outbox.Outbox), if it's given.
+        Duration of matching, preparing and posting, matches of every rule
+        and bytes posted are recorded in `stats` (a stats.Stats).
+        Requests are limited by rules' limits and by `limits` of their host
+        (a ratelimit.HostLimits), hosts are always paused when they answer
+        with 429 or 503.
+        Messages matched by a rule with 'batch_size' option are posted
+        in batches, see prepare_batch
+        """
         self.base_url = base_url
         if not mappings:
             mappings = []
         self.mappings = mappings
+        self.rules = [Rule(msg_rule, base_url) for msg_rule in mappings]
+        self.index = RuleIndex(self.rules)
+        self.rule_names = []
+        for position, rule in enumerate(self.rules):
+            if rule['name'] is None:
+                self.rule_names.append(metric_name('rules', position))
+            else:
+                self.rule_names.append(metric_name('rules', rule['name']))
+        self.workers = workers
+        if connections is None:
+            connections = ConnectionPool()
+        self.connections = connections
+        self.handlers = get_handlers(connections)
+        self.opener = urllib2.build_opener(*self.handlers)
+        if sessions is None:
+            sessions = auth.SessionCache(self.handlers)
+        self.sessions = sessions
+        self.outbox = outbox
+        if stats is None:
+            stats = NullStats()
+        self.stats = stats
+        if limits is None:
+            limits = HostLimits()
+        self.limits = limits
 
     def map(self, message):
-        for msg_rule in self.mappings:
-            try:
-                url = msg_rule['url']
-            except KeyError:
-                raise ConfigurationError('URL is required')
-            if self.base_url:
-                url = self.base_url.rstrip('/') + '/' + url.lstrip('/')
-            rule = DEFAULT_RULE.copy()
-            rule.update(msg_rule)
-            match_func = fnmatch.fnmatch
-            if rule['syntax'] == 'regexp':
-                mathc_func = re.match
-            match = True
-            for key, pattern in rule['conditions'].items():
-                value = message.get(key, None)
-                if not value:
-                    value = getattr(message, key, None)
-                if not value:
-                    match = False
-                    break
-                if type(pattern) in [list, tuple]:
-                    match &= any([match_func(value, item) for item in pattern])
-                elif isinstance(pattern, str):
-                    match &= match_func(value, pattern)
+        started = time.time()
+        try:
+            rules = self.rules
+            for position in self.index.candidates(message):
+                rule = rules[position]
+                if rule.match(message):
+                    self.stats.incr(self.rule_names[position])
+                    return rule.url, rule
+            self.stats.incr('rules.unmatched')
+            return None
+        finally:
+            self.stats.timing('match', time.time() - started)
+
+    def prepare(self, message, url, options):
+        """
+        Build a request for the message matched by a rule.
+        Everything that needs the message (and thus the backend connection)
+        is done here, so that the request can be sent from another thread
+        """
+        started = time.time()
+        try:
+            return self._prepare(message, url, options)
+        finally:
+            self.stats.timing('prepare', time.time() - started)
+
+    def _prepare(self, message, url, options):
+        data = self.get_params(message, options)
+        data.update(options['add_params'])
+        files = self.get_files(message, options)
+        if not files and options['format'] != 'multipart':
+            request = self.encode_json(url, [data],
+                                       options['format'] == 'ndjson')
+            if request is not None:
+                return request
+        data = MultipartParam.from_params(data)
+        data += files
+        datagen, headers = multipart_encode(data)
+        return urllib2.Request(url, datagen, headers)
+
+    def encode_json(self, url, items, lines=False):
+        """
+        A request with a JSON object of params as the body,
+        or a line of JSON per object of `items` if `lines` is set.
+        Returns None if params can't be encoded (text that isn't UTF-8)
+        """
+        try:
+            if lines:
+                body = ''.join([json.dumps(item, separators=(',', ':')) +
+                                '\n' for item in items])
+                content_type = CONTENT_TYPES['ndjson']
+            else:
+                body = json.dumps(items[0], separators=(',', ':'))
+                content_type = CONTENT_TYPES['json']
+        except UnicodeDecodeError:
+            return None
+        return urllib2.Request(url, body, {'Content-Type': content_type,
+                                           'Content-Length': str(len(body))})
+
+    def get_params(self, message, options):
+        """
+        Message params to include in the request ('msg_params' option)
+        """
+        data = {}
+        for name in options['msg_params']:
+            part = message.get(name, None)
+            if not part:
+                part = getattr(message, name, None)
+            if part: #TODO: maybe we should raise an exception
+                     #if there's no part
+                data[name] = part
+        return data
+
+    def get_files(self, message, options, prefix=''):
+        """
+        Attachments of the message as request params ('send_files' option),
+        named '<prefix>attachment[<num>]'
+        """
+        files = []
+        if options['send_files']:
+            for num, attachment in enumerate(message.attachments):
+                filename, ctype, fileobj = attachment
+                #Size is measured here, poster would ask for fileno(),
+                #which moves spooled attachments to disk
+                fileobj.seek(0, 2)
+                filesize = fileobj.tell()
+                fileobj.seek(0)
+                file_param = MultipartParam('%sattachment[%d]' %
+                                            (prefix, num),
+                                            filename=filename,
+                                            filetype=ctype,
+                                            filesize=filesize,
+                                            fileobj=fileobj)
+                files.append(file_param)
+        return files
+
+    def add_to_batch(self, batch, message):
+        """
+        Add params and attachments of the message to the batch,
+        while the message (and the backend connection) is at hand
+        """
+        started = time.time()
+        try:
+            prefix = 'message[%d]' % len(batch.messages)
+            batch.add(message, self.get_params(message, batch.options),
+                      self.get_files(message, batch.options, prefix))
+        finally:
+            self.stats.timing('prepare', time.time() - started)
+
+    def prepare_batch(self, batch):
+        """
+        Build a single request for all the messages of the batch.
+        Params of a message are named 'message[<num>][<name>]', its
+        attachments 'message[<num>][attachment][<num>]', 'add_params'
+        are sent once. With 'json' format, the body is an object with
+        'add_params' and a list of params of messages in 'messages', with
+        'ndjson' a line of params and 'add_params' per message.
+        The receiver may answer with results of every message
+        (see split_result)
+        """
+        started = time.time()
+        try:
+            options = batch.options
+            if not batch.files and options['format'] != 'multipart':
+                if options['format'] == 'json':
+                    items = [dict(options['add_params'],
+                                  messages=batch.params)]
                 else:
-                    raise ConfigurationError(\
-                                "Pattern should be string or list, not %s" %\
-                                             type(pattern))
-            if match:
-                return url, rule
-        return None
+                    items = []
+                    for params in batch.params:
+                        item = dict(params)
+                        item.update(options['add_params'])
+                        items.append(item)
+                request = self.encode_json(batch.url, items,
+                                           options['format'] == 'ndjson')
+                if request is not None:
+                    return request
+            data = []
+            for num, params in enumerate(batch.params):
+                data.extend([('message[%d][%s]' % (num, name), value)
+                             for name, value in params.items()])
+            data.extend(batch.options['add_params'].items())
+            data = MultipartParam.from_params(data)
+            data += batch.files
+            datagen, headers = multipart_encode(data)
+            return urllib2.Request(batch.url, datagen, headers)
+        finally:
+            self.stats.timing('prepare', time.time() - started)
+
+    def post(self, request, options):
+        """
+        Send the request, returns the response body or URLError.
+        Waits until limits of the rule (if `options` is a Rule)
+        and the host allow the request to be sent
+        """
+        if options.get('auth', None):
+            urlopen = self.sessions.get(options['auth'], self.base_url).open
+        else:
+            urlopen = self.opener.open
+        limiters = [self.limits.get(request.get_host())]
+        if getattr(options, 'limiter', None) is not None:
+            limiters.insert(0, options.limiter)
+        started = time.time()
+        for limiter in limiters:
+            limiter.acquire()
+        self.stats.timing('post.wait', time.time() - started)
+        started = time.time()
+        #Stays None if the request failed with an unexpected error,
+        #slots of the limiters are released all the same
+        result = None
+        try:
+            try:
+                result = urlopen(request).read()
+            except urllib2.URLError, e:
+                result = e
+        finally:
+            throttled = False
+            for limiter in reversed(limiters):
+                if limiter.release(result):
+                    throttled = True
+        if throttled:
+            self.stats.incr('post.throttled')
+        self.stats.timing('post', time.time() - started)
+        if isinstance(result, Exception):
+            self.stats.incr('post.errors')
+        else:
+            self.stats.incr('post.bytes',
+                            int(request.get_header('Content-length', 0)))
+        return result
 
-    def process(self, inbox):
+    def send(self, request, options):
+        result = self.post(request, options)
+        if self.outbox is not None and \
+                isinstance(result, urllib2.URLError) and \
+                is_transient(result):
+            auth_data = options.get('auth', None)
+            if auth_data:
+                auth_data = dict(auth_data,
+                                 url=auth.get_auth_url(auth_data,
+                                                       self.base_url))
+            self.outbox.add(request, {'auth': auth_data}, result)
+        return result
+
+    def process(self, inbox, done=None):
         """
         Inbox is expected to be a list of imap.Message objects.
         Although any list of mapping objects is accepted, provided
         that objects support methods enlisted in 'actions' option
+        `done` is called with every message once it's processed for good:
+        it matched no rule, it was posted, it failed permanently or it was
+        queued in the outbox. Messages that failed with a transient error
+        and weren't queued are left to be processed again.
+        A result is yielded for every message, messages posted in a batch
+        get their own results if the receiver gives them.
+        With worker pools, results are yielded in order of completion
         """
 
-        # Poster: Register the streaming http handlers with urllib2
-        register_openers()
+        results = Queue.Queue()
+        pools = {}
+        in_flight = 0
+        try:
+            for messages, url, options, request in self._requests(inbox,
+                                                                  done):
+                pool = self._get_pool(options, pools, results)
+                if not pool:
+                    result = self.send(request, options)
+                    for item in self._finish(messages, url, options,
+                                             result, done):
+                        yield item
+                    continue
+                pool.submit((messages, url, options), request, options)
+                in_flight += 1
+                #Don't let the backlog of prepared requests grow unbounded
+                limit = 2 * sum([pool.size for pool in pools.values()])
+                while in_flight >= limit or not results.empty():
+                    in_flight -= 1
+                    for item in self._collect(results, done):
+                        yield item
+            while in_flight:
+                in_flight -= 1
+                for item in self._collect(results, done):
+                    yield item
+        finally:
+            for pool in pools.values():
+                pool.close()
 
+    def _requests(self, inbox, done):
+        """
+        Map messages of the inbox, yields (messages, url, options, request)
+        for every request to send: a message or a batch of them.
+        Batches that are ready are sent as messages come, the rest
+        once the inbox is over.
+        Messages whose parts are posted are parsed ahead (in worker
+        processes, or downloaded together if they are lazy), up to
+        PARSE_AHEAD of them, before they are prepared
+        """
+        batches = {}
+        ahead = collections.deque()
         for message in inbox:
             res = self.map(message)
-            if not res:
-                continue
-            url, options = res
-            for action in options['actions']:
-                getattr(message, action)()
-            files = []
-            if options['send_files']:
-                for num, attachment in enumerate(message.attachments):
-                    filename, ctype, fileobj = attachment
-                    file_param = MultipartParam('attachment[%d]' % num,
-                                                filename=filename,
-                                                filetype=ctype,
-                                                fileobj=fileobj)
-                    files.append(file_param)
-            data = {}
-            for name in options['msg_params']:
-                part = message.get(name, None)
-                if not part:
-                    part = getattr(message, name, None)
-                if part: #TODO: maybe we should raise an exception
-                         #if there's no part
-                    data[name] = part
-            data.update(options['add_params'])
-            data = MultipartParam.from_params(data)
-            data += files
-            datagen, headers = multipart_encode(data)
-            request = urllib2.Request(url, datagen, headers)
-            if options.get('auth', None):
-                cj, urlopener = auth.authenticate(options['auth'], request, 
-                                                  self.base_url)
+            if res:
+                url, options = res
+                ahead.append((message, url, options))
+                limit = 0
+                if getattr(options, 'uses_parts', True) and \
+                        getattr(message, 'parse_ahead', None) and \
+                        message.parse_ahead(options['send_files']):
+                    limit = PARSE_AHEAD
+                while len(ahead) > limit:
+                    for job in self._add(ahead.popleft(), batches):
+                        yield job
+            elif done:
+                done(message)
+            for job in self._ready(batches):
+                yield job
+        while ahead:
+            for job in self._add(ahead.popleft(), batches):
+                yield job
+        for batch in sorted(batches.values(),
+                            key=lambda batch: batch.started):
+            yield batch.messages, batch.url, batch.options, \
+                self.prepare_batch(batch)
+
+    def _add(self, matched, batches):
+        """
+        Prepare a request for the matched message, or add it to the
+        batch of its rule
+        """
+        message, url, options = matched
+        if not options['defer_actions']:
+            self.run_actions(message, options)
+        if not options['batch_size']:
+            yield [message], url, options, self.prepare(message, url,
+                                                        options)
+            return
+        batch = batches.get(options, None)
+        if batch is None:
+            batch = batches[options] = Batch(url, options)
+        self.add_to_batch(batch, message)
+        for job in self._ready(batches):
+            yield job
+
+    def _ready(self, batches):
+        now = time.time()
+        for options, batch in batches.items():
+            if batch.ready(now):
+                del batches[options]
+                yield batch.messages, batch.url, options, \
+                    self.prepare_batch(batch)
+
+    def _get_pool(self, options, pools, results):
+        if options.get('workers'):
+            key = options
+            size = options['workers']
+        elif self.workers:
+            key = None
+            size = self.workers
+        else:
+            return None
+        if key not in pools:
+            pools[key] = WorkerPool(self.send, size, results)
+        return pools[key]
+
+    def run_actions(self, message, options):
+        for action in options['actions']:
+            getattr(message, action)()
+
+    def _finish(self, messages, url, options, result, done):
+        """
+        Run deferred actions of messages that were posted,
+        returns (url, result) for every message
+        """
+        if options['batch_size']:
+            message_results = split_result(result, len(messages))
+        else:
+            message_results = [result]
+        finished = []
+        for message, message_result in zip(messages, message_results):
+            if isinstance(message_result, BatchItemError):
+                self.stats.incr('post.rejected')
+            if options['defer_actions'] and \
+                    (not isinstance(message_result, Exception) or
+                     self._queued(message_result)):
+                self.run_actions(message, options)
+            if done and self._processed(message_result):
+                done(message)
+            finished.append((url, message_result))
+        return finished
+
+    def _processed(self, result):
+        """
+        Whether a message with the result of its post shouldn't be
+        processed again: it was posted, it failed permanently
+        or it was queued in the outbox (see send)
+        """
+        if not isinstance(result, urllib2.URLError) or \
+                not is_transient(result):
+            return True
+        return self._queued(result)
+
+    def _queued(self, result):
+        """
+        Whether the post failed with a transient error and was queued
+        in the outbox (see send)
+        """
+        return self.outbox is not None and \
+            isinstance(result, urllib2.URLError) and is_transient(result)
+
+    def _collect(self, results, done):
+        (messages, url, options), result, exc_info = results.get()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._finish(messages, url, options, result, done)
+
+
+class Inbox(object):
+    """
+    A mailbox processed over its own IMAP connection,
+    with its own query and rules
+    """
+
+    def __init__(self, client, mailbox, query, mapper, store=None,
+                 expunge=False, prefetch=0, stats=None):
+        """
+        `store` is a checkpoint.CheckpointStore to process only messages
+        that weren't processed yet.
+        Flags set by actions are stored in batches, if `expunge` is set
+        deleted messages are expunged after every batch.
+        If `prefetch` is set, up to that many chunks of messages are
+        downloaded by a separate thread while previous ones are posted.
+        Messages posted and time spent on the mailbox are recorded in
+        `stats` ('mailboxes.<user>@<host>/<mailbox>')
+        """
+        self.client = client
+        self.mailbox = mailbox
+        self.query = query
+        self.mapper = mapper
+        self.store = store
+        self.expunge = expunge
+        self.prefetch = prefetch
+        if stats is None:
+            stats = NullStats()
+        self.stats = stats
+        self.checkpoint = None
+        self.msg_list = None
+
+    def load_messages(self):
+        """
+        Search for messages to process, selecting the mailbox first
+        if it isn't selected yet
+        """
+        client = self.client
+        if not client.mailbox:
+            client.select(self.mailbox)
+            self.checkpoint = None
+            if self.store:
+                #Saved after chunks of messages (see process), not by
+                #done messages, whose flags may not be stored yet
+                self.checkpoint = self.store.checkpoint(
+                        '%s@%s/%s' % (client.username, client.host,
+                                      client.mailbox),
+                        client.uidvalidity, save_every=0)
+        after_uid = None
+        if self.checkpoint:
+            after_uid = self.checkpoint.last_uid
+        self.msg_list = getattr(client, self.query)(after_uid)
+        self.msg_list.batch_flags(self.expunge)
+
+    def process(self):
+        """
+        Process messages found by load_messages, yields (url, result)
+        """
+        name = metric_name('mailboxes', '%s@%s/%s' % (self.client.username,
+                                                      self.client.host,
+                                                      self.mailbox))
+        started = time.time()
+        fetched = self.msg_list
+        if self.prefetch:
+            fetched = prefetch(self.msg_list,
+                               self.prefetch * self.msg_list.chunk_size)
+        messages = fetched
+        done = None
+        if self.checkpoint:
+            #Messages that failed in a previous cycle are processed again
+            self.checkpoint.reset()
+            #Flags of messages done so far are stored before every save,
+            #by the thread iterating over messages (with prefetch too),
+            #which is the only one that uses the IMAP connection meanwhile
+            self.checkpoint.before_save = self.msg_list.flush
+            self.msg_list.on_chunk = self.checkpoint.save
+            messages = self._track(fetched)
+            done = self._done
+        try:
             try:
-                result = urllib2.urlopen(request).read()
-            except urllib2.URLError, e:
-                result = e
-                #continue    # TODO Log error and proceed.
-            yield url, result
+                for url, result in self.mapper.process(messages, done):
+                    self.stats.incr(name + '.posted')
+                    yield url, result
+            finally:
+                if self.prefetch:
+                    #The IMAP connection is used by this thread only again
+                    fetched.close()
+                #Flags are stored before messages are checkpointed
+                if self.checkpoint:
+                    self.checkpoint.save()
+                else:
+                    self.msg_list.flush()
+        finally:
+            self.stats.timing(name, time.time() - started)
+
+    def serve(self, idle_interval=DEFAULT_IDLE_INTERVAL,
+              poll_interval=DEFAULT_POLL_INTERVAL,
+              max_backoff=DEFAULT_MAX_BACKOFF):
+        """
+        Process messages as they arrive, until interrupted.
+        The IMAP connection is kept open and new messages are waited for
+        with IDLE (or polled for with NOOP, see ImapClient.idle).
+        A broken connection is reestablished, waiting 1, 2, 4... up to
+        `max_backoff` seconds between attempts
+        """
+        connected = False
+        backoff = 0
+        while True:
+            try:
+                self.load_messages()
+                connected = True
+                for url, result in self.process():
+                    yield url, result
+                backoff = 0
+                self.client.idle(idle_interval, poll_interval)
+            except (imaplib.IMAP4.error, socket.error, select.error):
+                if not connected:
+                    raise
+                if backoff:
+                    time.sleep(backoff)
+                backoff = min(max(1, 2 * backoff), max_backoff)
+                self.client.reset()
+
+    def close(self):
+        self.client.disconnect()
+
+    def _track(self, msg_list):
+        for message in msg_list:
+            #Messages posted after one that failed aren't posted again
+            if not self.checkpoint.track(message.uid):
+                yield message
+
+    def _done(self, message):
+        self.checkpoint.done(message.uid)
 
 
 class Handler(object):
@@ -155,39 +953,252 @@ class Handler(object):
                 import yaml
                 config = yaml.load(open(config_file, 'r'))
         self.config = config
+        #Stats of all the runs, StatsD server is given as 'host:port'
+        exporters = []
+        if config.get('statsd', None):
+            host, port = (config['statsd'].split(':') +
+                          [DEFAULT_STATSD_PORT])[:2]
+            exporters.append(StatsdExporter(
+                host, int(port),
+                config.get('statsd_prefix', DEFAULT_STATSD_PREFIX)))
+        self.stats = Stats(exporters)
 
     def load_backend(self):
-        if self.config['backend'] == 'imap':
-            host = self.config.get('host', None)
+        """
+        Load shared settings and all the accounts.
+        Accounts are listed in 'accounts' option, each one with its own
+        backend settings, mailboxes and rules. Options that aren't set for
+        an account are taken from the top level of configuration.
+        Without 'accounts', the configuration describes a single account
+        """
+        config = self.config
+        checkpoint_file = config.get('checkpoint', None)
+        self.workers = config.get('workers', 0)
+        self.imap_connections = config.get('imap_connections',
+                                           DEFAULT_IMAP_CONNECTIONS)
+        self.connections = ConnectionPool(
+            config.get('max_connections', DEFAULT_MAX_CONNECTIONS),
+            config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT))
+        self.limits = HostLimits(config.get('host_rate_limit', None),
+                                 config.get('host_burst', None),
+                                 config.get('host_max_in_flight', None),
+                                 config.get('max_pause', DEFAULT_MAX_PAUSE))
+        self.sessions = auth.SessionCache(
+            get_handlers(self.connections),
+            config.get('session_dir', None),
+            config.get('session_ttl', auth.DEFAULT_SESSION_TTL),
+            self.stats)
+        self.idle_interval = config.get('idle_interval',
+                                        DEFAULT_IDLE_INTERVAL)
+        self.poll_interval = config.get('poll_interval',
+                                        DEFAULT_POLL_INTERVAL)
+        self.max_backoff = config.get('max_backoff', DEFAULT_MAX_BACKOFF)
+        #Worker processes are started before any other thread
+        self.parser = None
+        if config.get('parse_processes', 0):
+            self.parser = ParserPool(config['parse_processes'])
+        self.store = None
+        if checkpoint_file:
+            self.store = CheckpointStore(checkpoint_file)
+        self.outbox = None
+        if config.get('outbox', None):
+            self.outbox = Outbox(
+                config['outbox'],
+                config.get('max_attempts', DEFAULT_MAX_ATTEMPTS),
+                config.get('retry_delay', DEFAULT_RETRY_DELAY),
+                config.get('max_retry_delay', DEFAULT_MAX_RETRY_DELAY))
+
+        accounts = config.get('accounts', None)
+        if accounts is None:
+            accounts = [config]
+        elif not accounts:
+            raise ConfigurationError("'accounts' option is empty")
+        else:
+            defaults = dict(config)
+            del defaults['accounts']
+            accounts = [dict(defaults, **account) for account in accounts]
+        per_account = [self.load_account(account) for account in accounts]
+        #Mailboxes of different accounts take turns, so that a single
+        #account with many mailboxes doesn't hold all the connections
+        self.inboxes = []
+        for num in range(max([len(inboxes) for inboxes in per_account])):
+            for inboxes in per_account:
+                if num < len(inboxes):
+                    self.inboxes.append(inboxes[num])
+
+    def load_account(self, config):
+        """
+        Returns a list of Inbox objects for mailboxes of an account
+        """
+        if config.get('backend', None) == 'imap':
+            host = config.get('host', None)
             if not host:
                 raise ConfigurationError("'host' option is required")
-            username = self.config.get('username', None)
+            username = config.get('username', None)
             if not username:
                 raise ConfigurationError("'username' option is required")
-            password = self.config.get('password', None)
+            password = config.get('password', None)
             if not password:
                 raise ConfigurationError("'password' option is required")
-            port = self.config.get('port', None)
-            ssl = self.config.get('ssl', False)
-            query = self.config.get('query', 'all')
-            if not query in ['all', 'unseen', 'undeleted']:
-                raise ConfigurationError("Unknown query: %s" % query)
-            mailboxes = self.config.get('inboxes', ['INBOX'])
-            self.base_url = self.config.get('base_url', None)
-
-            self.rules = self.config['rules']
-            client = ImapClient(host, username, password, port, ssl)
-            self.msg_list = getattr(client, query)()
+            port = config.get('port', None)
+            ssl = config.get('ssl', False)
+            query = config.get('query', 'all')
+            mailboxes = config.get('inboxes', ['INBOX'])
+            chunk_size = config.get('chunk_size', DEFAULT_CHUNK_SIZE)
+            chunk_bytes = config.get('chunk_bytes', DEFAULT_CHUNK_BYTES)
+            lazy = config.get('lazy', False)
+            cache_size = config.get('cache_size', DEFAULT_CACHE_SIZE)
+            cache_bytes = config.get('cache_bytes', DEFAULT_CACHE_BYTES)
+            spool_size = config.get('spool_size', DEFAULT_SPOOL_SIZE)
+            expunge = config.get('expunge', False)
+            prefetch = config.get('prefetch', 0)
+            if prefetch and lazy:
+                #Lazy messages download their parts while being posted,
+                #over the connection used by the prefetching thread
+                raise ConfigurationError("'prefetch' can't be used with "
+                                         "'lazy' option")
+            base_url = config.get('base_url', None)
+
+            mapper = self.get_mapper(config['rules'], base_url)
+            inboxes = []
+            for mailbox in mailboxes:
+                #A mailbox is either a name or a mapping with 'name' and,
+                #optionally, its own 'query' and 'rules'
+                if isinstance(mailbox, basestring):
+                    mailbox = {'name': mailbox}
+                if not mailbox.get('name', None):
+                    raise ConfigurationError("Mailbox 'name' is required")
+                inbox_query = mailbox.get('query', query)
+                if not inbox_query in ['all', 'unseen', 'undeleted']:
+                    raise ConfigurationError("Unknown query: %s" %
+                                             inbox_query)
+                inbox_mapper = mapper
+                if 'rules' in mailbox:
+                    inbox_mapper = self.get_mapper(mailbox['rules'],
+                                                   base_url)
+                client = ImapClient(host, username, password, port, ssl,
+                                    chunk_size, lazy, cache_size,
+                                    cache_bytes, spool_size, self.parser,
+                                    self.stats, chunk_bytes)
+                inboxes.append(Inbox(client, mailbox['name'], inbox_query,
+                                     inbox_mapper, self.store, expunge,
+                                     prefetch, self.stats))
+            return inboxes
         else:
             raise ConfigurationError("Backend '%s' is not supported" %\
-                                     self.config['backend'])
+                                     config.get('backend', None))
+
+    def get_mapper(self, rules, base_url=None):
+        return Mapper(rules, base_url, self.workers, self.connections,
+                      self.sessions, self.outbox, self.stats, self.limits)
 
     def process(self):
+        """
+        Retry deliveries from the outbox that are due, then process all
+        mailboxes of all accounts, up to 'imap_connections' of them at
+        the same time.
+        Results of all mailboxes are yielded as they come
+        """
         self.load_backend()
-        mapper = Mapper(self.rules, self.base_url)
-        for url, result in mapper.process(self.msg_list):
+        if len(self.inboxes) == 1:
+            processed = self._process_inbox(self.inboxes[0])
+        else:
+            processed = self._merge(
+                [(self._process_inbox, (inbox,)) for inbox in self.inboxes],
+                min(self.imap_connections, len(self.inboxes)))
+        return self._closing(itertools.chain(self._retry(), processed))
+
+    def serve(self):
+        """
+        Process messages of all mailboxes as they arrive, until interrupted
+        (see Inbox.serve). Every mailbox keeps its own connection open.
+        Messages that were processed aren't processed again, as if
+        'checkpoint' option was set (by default it's kept in memory only)
+        """
+        if not self.config.get('checkpoint', None):
+            self.config = dict(self.config, checkpoint=':memory:')
+        self.load_backend()
+        jobs = [(self._serve_inbox, (inbox,)) for inbox in self.inboxes]
+        if self.outbox is not None:
+            jobs.append((self._retry_forever, ()))
+        if len(jobs) == 1:
+            return self._closing(self._serve_inbox(self.inboxes[0]))
+        return self._closing(self._merge(jobs, len(jobs), wait=False))
+
+    def _closing(self, results):
+        try:
+            for url, result in results:
+                yield url, result
+        finally:
+            if self.parser is not None:
+                self.parser.close()
+
+    def _process_inbox(self, inbox):
+        try:
+            inbox.load_messages()
+            for url, result in inbox.process():
+                yield url, result
+        finally:
+            inbox.close()
+
+    def _serve_inbox(self, inbox):
+        return inbox.serve(self.idle_interval, self.poll_interval,
+                           self.max_backoff)
+
+    def _retry(self):
+        if self.outbox is None:
+            return
+        for url, result in self.outbox.retry(self.get_mapper([]).post):
             yield url, result
 
+    def _retry_forever(self):
+        while True:
+            for url, result in self._retry():
+                yield url, result
+            #Deliveries queued meanwhile are due in retry_delay at least
+            delay = self.outbox.retry_delay
+            next_attempt = self.outbox.next_attempt()
+            if next_attempt is not None:
+                delay = min(delay, next_attempt - time.time())
+            time.sleep(max(delay, 1))
+
+    def _merge(self, jobs, size, wait=True):
+        """
+        Run func(*args) generators for all (func, args) jobs in a pool of
+        `size` threads, yield their results as they come.
+        Unless `wait` is set, threads aren't waited for when stopped
+        (they may be waiting for new messages)
+        """
+        results = Queue.Queue()
+        stopped = threading.Event()
+
+        def run(func, args):
+            items = func(*args)
+            try:
+                for item in items:
+                    results.put((None, item, None))
+                    if stopped.isSet():
+                        break
+            finally:
+                items.close()
+
+        pool = WorkerPool(run, size, results)
+        for num, (func, args) in enumerate(jobs):
+            pool.submit(num, func, args)
+        remaining = len(jobs)
+        try:
+            while remaining:
+                job, item, exc_info = wait_for(results)
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if job is None:
+                    yield item
+                else:
+                    remaining -= 1
+        finally:
+            stopped.set()
+            pool.close(wait)
+
 
 if __name__ == '__main__':
     sample_rules = [
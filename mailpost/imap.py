@@ -8,8 +8,22 @@ Mailpost version 0.1
 
 import imaplib
 import email
+import os
+import select
+import shutil
+import socket
+import time
+import binascii
+import quopri
+import tempfile
+import threading
 from cStringIO import StringIO
 import re
+import multiprocessing
+
+from mailpost.cache import LRUCache
+from mailpost.mime import split_headers, walk_parts
+from mailpost.stats import NullStats, metric_name
 
 #WARNING: This module is at very early stage of development
 
@@ -21,30 +35,539 @@ import re
 #TODO: Lot's of stuff
 # Most important
 # 1. Dates!!
-# 2. Download only headers of a message until body or attachments are
-# requested
-# 3. Encodings support
+# 2. Encodings support
 
 SENDER_EXPR = re.compile(r'[\w\.]+@[\w\.-]+')
 #Doesn't care for email validity much
 
+FETCH_START_EXPR = re.compile(r'^\d+ \(')
+LITERAL_EXPR = re.compile(r'\{\d+\}$')
+TOKEN_EXPR = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+QUOTED_CHAR_EXPR = re.compile(r'\\(.)')
+
+#How many messages (and how many bytes of them, unless they are lazy)
+#are requested by a single UID FETCH command
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_CHUNK_BYTES = 32 * 1024 * 1024
+
+#How many messages (and how many bytes of them) MessageList keeps in memory
+DEFAULT_CACHE_SIZE = 500
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+#How long (in seconds) to wait in IDLE before checking the mailbox anyway.
+#RFC 2177 asks clients to reissue IDLE at least every 29 minutes
+DEFAULT_IDLE_INTERVAL = 29 * 60
+#How often (in seconds) to poll with NOOP if the server doesn't support IDLE
+DEFAULT_POLL_INTERVAL = 60
+
+#Untagged responses that announce new messages
+NEW_MAIL_EXPR = re.compile(r'^\* \d+ (EXISTS|RECENT)\b', re.IGNORECASE)
+NEW_MAIL_RESPONSES = ('EXISTS', 'RECENT')
+
+#Attachments bigger than that (in bytes) are kept in temporary files
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+DECODE_BLOCK_SIZE = 64 * 1024
+
+#What is downloaded for a message
+EAGER_FETCH_ITEMS = '(UID BODY.PEEK[])'
+LAZY_FETCH_ITEMS = '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+
+def buffered(connection):
+    """
+    Whether data was received but not read yet by imaplib connection:
+    it's kept by the file object of the socket or by SSL,
+    where select() doesn't see it
+    """
+    rbuf = getattr(getattr(connection, 'file', None), '_rbuf', None)
+    if rbuf is not None and rbuf.tell():
+        return True
+    pending = getattr(getattr(connection, 'sslobj', None), 'pending', None)
+    return bool(pending and pending())
+
+
+def uid_set(uids):
+    """
+    Compress a list of UIDs into an IMAP sequence set,
+    e.g. ['1', '2', '3', '7'] -> '1:3,7'
+    """
+    numbers = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join([start == end and str(start) or '%d:%d' % (start, end)
+                     for start, end in ranges])
+
+
+class StatsMixin:
+    """
+    Records duration of every IMAP command (like 'imap.UID_FETCH')
+    and bytes of messages fetched ('imap.bytes') in `stats`
+    """
+    stats = NullStats()
+
+    def _simple_command(self, name, *args):
+        command = name
+        if name == 'UID':
+            command = 'UID ' + args[0].upper()
+        started = time.time()
+        try:
+            result = imaplib.IMAP4._simple_command(self, name, *args)
+        finally:
+            self.stats.timing(metric_name('imap', command),
+                              time.time() - started)
+        if command.endswith('FETCH'):
+            #Literals are kept in untagged responses until they are taken
+            received = sum([len(item[1]) for item
+                            in self.untagged_responses.get('FETCH', [])
+                            if isinstance(item, tuple)])
+            self.stats.incr('imap.bytes', received)
+        return result
+
+
+class StatsIMAP4(StatsMixin, imaplib.IMAP4):
+    pass
+
+
+class StatsIMAP4_SSL(StatsMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+def _parse_response(segments):
+    """
+    Build nested lists out of a single untagged response.
+    `segments` is a list of (text, literal) pairs, as returned by imaplib,
+    NIL is returned as None
+    """
+    stack = [[]]
+    for text, literal in segments:
+        if literal is not None:
+            text = LITERAL_EXPR.sub('', text.rstrip())
+        for match in TOKEN_EXPR.finditer(text):
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                if len(stack) > 1:
+                    group = stack.pop()
+                    stack[-1].append(group)
+            elif quoted is not None:
+                stack[-1].append(QUOTED_CHAR_EXPR.sub(r'\1', quoted))
+            elif atom.upper() == 'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(atom)
+        if literal is not None:
+            stack[-1].append(literal)
+    while len(stack) > 1:
+        group = stack.pop()
+        stack[-1].append(group)
+    return stack[0]
+
+
+def parse_fetch(data):
+    """
+    Split the response of a (multi-message) UID FETCH into a mapping of
+    UID -> {item name: value}, e.g.
+    {'7': {'UID': '7', 'RFC822.SIZE': '1024', 'BODY[HEADER]': '...'}}
+    Depending on the server, UID may come either before or after literals
+    """
+    responses = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        if FETCH_START_EXPR.match(text) or not responses:
+            responses.append([])
+        responses[-1].append((text, literal))
+    fetched = {}
+    for segments in responses:
+        parsed = _parse_response(segments)
+        if len(parsed) < 2 or not isinstance(parsed[1], list):
+            continue
+        values = parsed[1]
+        items = dict(zip([name.upper() for name in values[::2]],
+                         values[1::2]))
+        if 'UID' in items:
+            fetched[items['UID']] = items
+    return fetched
+
+
+def _pairs(values):
+    if not isinstance(values, list):
+        return {}
+    return dict(zip([name.lower() for name in values[::2]], values[1::2]))
+
+
+def parse_bodystructure(structure, section=None):
+    """
+    Flatten a parsed BODYSTRUCTURE into a list of
+    (section, content type, filename, encoding) for its leaf parts.
+    Parts of attached messages are included, like in email package
+    """
+    if structure and isinstance(structure[0], list):
+        parts = []
+        number = 0
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            number += 1
+            if section:
+                subsection = '%s.%d' % (section, number)
+            else:
+                subsection = str(number)
+            parts.extend(parse_bodystructure(item, subsection))
+        return parts
+    ctype = ('%s/%s' % (structure[0], structure[1])).lower()
+    if ctype == 'message/rfc822' and len(structure) > 8 and \
+            isinstance(structure[8], list) and structure[8]:
+        #Parts of the attached message are numbered n.1, n.2...,
+        #its only part if it isn't multipart is n.1
+        body = structure[8]
+        if not isinstance(body[0], list):
+            return parse_bodystructure(body, '%s.1' % (section or '1'))
+        return parse_bodystructure(body, section or '1')
+    encoding = (structure[5] or '7bit').lower()
+    #Extension data goes after type specific fields
+    if ctype == 'message/rfc822':
+        extension = 10
+    elif ctype.startswith('text/'):
+        extension = 8
+    else:
+        extension = 7
+    filename = None
+    if len(structure) > extension + 1:
+        disposition = structure[extension + 1]
+        if isinstance(disposition, list) and len(disposition) > 1:
+            filename = _pairs(disposition[1]).get('filename')
+    if not filename:
+        filename = _pairs(structure[2]).get('name')
+    return [(section or '1', ctype, filename, encoding)]
+
+
+def decode_payload_to(payload, encoding, fileobj):
+    """
+    Decode payload into a file block by block, so that the whole decoded
+    payload is never kept in memory at once
+    """
+    if encoding == 'quoted-printable':
+        quopri.decode(StringIO(payload), fileobj)
+        return
+    source = StringIO(payload)
+    rest = ''
+    while True:
+        block = source.read(DECODE_BLOCK_SIZE)
+        if not block:
+            break
+        if encoding != 'base64':
+            fileobj.write(block)
+            continue
+        block = rest + ''.join(block.split())
+        usable = len(block) - len(block) % 4
+        fileobj.write(binascii.a2b_base64(block[:usable]))
+        rest = block[usable:]
+    if rest:
+        try:
+            fileobj.write(binascii.a2b_base64(rest))
+        except binascii.Error:
+            #Incorrect padding, ignore it like email package does
+            pass
+
+
+def parse_parts(raw, headers, spool):
+    """
+    Extract bodies and attachments from a raw message.
+    Parts are found without parsing the whole message (see
+    mime.walk_parts), attachments are decoded straight from the raw
+    message by `spool(payload, encoding)`.
+    Returns (text bodies, html bodies, [(filename, type, spooled)])
+    """
+    text_bodies = []
+    html_bodies = []
+    attachments = []
+    for headers, start, end in walk_parts(raw, headers=headers):
+        filename = headers.get_filename()
+        ctype = headers.get_content_type()
+        if filename:
+            encoding = headers.get('content-transfer-encoding', '')
+            encoding = encoding.strip().lower()
+            if encoding in ('', '7bit', '8bit', 'binary', 'base64',
+                            'quoted-printable'):
+                payload = buffer(raw, start, end - start)
+            else:
+                #Leave the rest (e.g. uuencode) to email package
+                part = email.message_from_string(headers.as_string() +
+                                                 raw[start:end])
+                payload = part.get_payload(decode=True) or ''
+                encoding = ''
+            attachments.append((filename, ctype, spool(payload, encoding)))
+        elif ctype == 'text/plain':
+            text_bodies.append(raw[start:end])
+        elif ctype == 'text/html':
+            html_bodies.append(raw[start:end])
+    return text_bodies, html_bodies, attachments
+
+
+def parse_message(raw, spool_size, directory):
+    """
+    Parse a raw message in a worker process of ParserPool.
+    Attachments bigger than `spool_size` bytes (before decoding) are
+    decoded into files in `directory`, the others are kept in memory.
+    Returns a record like parse_parts does, where attachments are
+    (filename, type, data, path) with either data or path
+    """
+
+    def spool(payload, encoding):
+        if spool_size and len(payload) > spool_size:
+            fd, path = tempfile.mkstemp(dir=directory)
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                decode_payload_to(payload, encoding, fileobj)
+            finally:
+                fileobj.close()
+            return None, path
+        fileobj = StringIO()
+        decode_payload_to(payload, encoding, fileobj)
+        return fileobj.getvalue(), None
+
+    text_bodies, html_bodies, attachments = parse_parts(raw, None, spool)
+    return text_bodies, html_bodies, [(filename, ctype, data, path)
+                                      for filename, ctype, (data, path)
+                                      in attachments]
+
+
+class ParserPool(object):
+    """
+    Worker processes parsing downloaded messages, so that decoding of
+    attachments uses all the cores while the main process keeps IMAP and
+    HTTP connections busy. Messages are submitted once it's known their
+    parts will be needed (see Message.parse_ahead), and their parts are
+    waited for when they are needed.
+    Big attachments are passed back in temporary files, which are removed
+    by `close` if they weren't used
+    """
+
+    def __init__(self, processes=None):
+        self.directory = tempfile.mkdtemp(prefix='mailpost-')
+        self._pool = multiprocessing.Pool(processes)
+
+    def submit(self, raw, spool_size):
+        """
+        Returns multiprocessing.AsyncResult of parse_message
+        """
+        return self._pool.apply_async(parse_message,
+                                      (raw, spool_size, self.directory))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        shutil.rmtree(self.directory, True)
+
+
+class FlagBatch(object):
+    """
+    Flags added to messages, stored by `flush` with a single UID STORE
+    command per flag. If `expunge` is set, deleted messages are expunged:
+    only the ones deleted here if the server supports UIDPLUS (RFC 4315),
+    otherwise all the messages flagged as deleted in the mailbox
+    """
+
+    def __init__(self, session, expunge=False):
+        self.session = session
+        self.expunge = expunge
+        self._uids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum([len(uids) for uids in self._uids.values()])
+
+    def add(self, uid, flag):
+        self._lock.acquire()
+        try:
+            self._uids.setdefault(flag, set()).add(uid)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            pending = self._uids
+            self._uids = {}
+        finally:
+            self._lock.release()
+        for flag, uids in sorted(pending.items()):
+            status, data = self.session.uid('STORE', uid_set(uids),
+                                            '+FLAGS', flag)
+            if status != 'OK':
+                raise Exception(data)
+        if self.expunge and r'\Deleted' in pending:
+            if 'UIDPLUS' in getattr(self.session, 'capabilities', ()):
+                status, data = self.session.uid(
+                        'EXPUNGE', uid_set(pending[r'\Deleted']))
+            else:
+                status, data = self.session.expunge()
+            if status != 'OK':
+                raise Exception(data)
+
+
+class PartsBatch(object):
+    """
+    Lazy messages whose parts will be needed, see Message.parse_ahead.
+    Parts of all of them are downloaded when the first one needs its
+    parts, with a single UID FETCH per distinct set of sections
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message, attachments=True):
+        self._lock.acquire()
+        try:
+            self._pending[message.uid] = (message, attachments)
+        finally:
+            self._lock.release()
+
+    def load(self, message):
+        """
+        Download parts of pending messages if the message is one of them,
+        returns True if it was
+        """
+        self._lock.acquire()
+        try:
+            if message.uid not in self._pending:
+                return False
+            pending = self._pending
+            self._pending = {}
+        finally:
+            self._lock.release()
+        groups = {}
+        for pending_message, attachments in pending.values():
+            text_parts, file_parts = pending_message.wanted_parts(attachments)
+            key = tuple([part[0] for part in text_parts + file_parts])
+            groups.setdefault(key, []).append((pending_message, attachments,
+                                               text_parts, file_parts))
+        for sections, messages in groups.items():
+            fetched = {}
+            if sections:
+                items = '(UID %s)' % ' '.join(['BODY.PEEK[%s]' % section
+                                               for section in sections])
+                status, data = self.session.uid(
+                        'FETCH', uid_set([item[0].uid for item in messages]),
+                        items)
+                if status != 'OK':
+                    raise Exception(data)
+                fetched = parse_fetch(data)
+            for pending_message, attachments, text_parts, file_parts \
+                    in messages:
+                data = fetched.get(pending_message.uid, {})
+                payloads = [data.get('BODY[%s]' % section) or ''
+                            for section in sections]
+                pending_message.set_parts(text_parts, file_parts, payloads,
+                                          attachments)
+        return True
+
 
 class Message(object):
 
-    def __init__(self, session, uid):
+    def __init__(self, session, uid, data=None, lazy=False,
+                 spool_size=DEFAULT_SPOOL_SIZE, parser=None, stats=None):
+        """
+        `data` is either a raw RFC822 message or a mapping of FETCH items,
+        if the message was already fetched (e.g. by MessageList in a batch),
+        otherwise it is fetched here.
+        A `lazy` message downloads only its headers and structure, bodies and
+        attachments are downloaded when they are accessed for the first time.
+        Attachments bigger than `spool_size` bytes are decoded into
+        temporary files, 0 keeps all of them in memory.
+        A downloaded message may be parsed by `parser` (a ParserPool),
+        see parse_ahead.
+        Time spent parsing is recorded in `stats` (a stats.Stats)
+        """
         self.session = session
         self.uid = uid
-        status, data = self.session.uid('FETCH', uid, '(RFC822)')
-        #status, data = self.session.uid('FETCH', uid, '(BODYSTRUCTURE)')
-        if status != 'OK':
-            raise Exception(data)
-        self._msg = email.message_from_string(data[0][1])
+        self.lazy = lazy
+        self.spool_size = spool_size
+        self.parser = parser
+        if stats is None:
+            stats = NullStats()
+        self.stats = stats
+        #FlagBatch to add flags to, they are stored at once if it's set
+        self.flag_batch = None
+        #PartsBatch to download parts of a lazy message with, if it's set
+        self.parts_batch = None
+        self.size = None
+        #Number of bytes of message payload downloaded so far
+        self.loaded_size = 0
+        self._parts = None
+        self._text_bodies = None
+        self._html_bodies = None
+        self._attachments = None
+        self._parsed = None
+        if data is None:
+            if lazy:
+                data = self._fetch(LAZY_FETCH_ITEMS)
+            else:
+                status, response = self.session.uid('FETCH', uid,
+                                                    '(BODY.PEEK[])')
+                if status != 'OK':
+                    raise Exception(response)
+                data = response[0][1]
+        if isinstance(data, dict):
+            if data.get('RFC822.SIZE'):
+                self.size = int(data['RFC822.SIZE'])
+            if 'BODY[]' in data:
+                data = data['BODY[]']
+            else:
+                self.lazy = True
+                self._parts = parse_bodystructure(data['BODYSTRUCTURE'])
+                data = data['BODY[HEADER]']
+        #Only headers are parsed now, parts of a downloaded message
+        #are parsed when they are needed (see _parse)
+        self._raw = None
+        body_start = len(data)
+        if not self.lazy:
+            self._raw = data
+            body_start = split_headers(data)
+        self._msg = email.message_from_string(data[:body_start])
+        self.loaded_size = len(data)
+        if self.size is None and not self.lazy:
+            self.size = len(data)
         self._prepare()
 
+    def parse_ahead(self, attachments=True):
+        """
+        Start parsing the downloaded message in the parser, if there is
+        one, so that its parts are ready by the time they are needed.
+        A lazy message is added to its parts batch instead, to download
+        its bodies (and `attachments`) along with other messages.
+        Only messages whose parts will be used should be parsed ahead,
+        their big attachments are kept in files until then.
+        Returns True if parsing was started
+        """
+        if self.lazy:
+            if self.parts_batch is None or self._text_bodies is not None:
+                return False
+            self.parts_batch.add(self, attachments)
+            return True
+        if self.parser is None or self._raw is None or \
+                self._parsed is not None:
+            return False
+        self._parsed = self.parser.submit(self._raw, self.spool_size)
+        self._raw = None
+        return True
+
     def _prepare(self):
-        self.text_bodies = []
-        self.html_bodies = []
-        self.attachments = []
         self.sender = ''
         self.receiver = ''
         sender = SENDER_EXPR.search(self._msg['from'])
@@ -53,17 +576,155 @@ class Message(object):
         receiver = SENDER_EXPR.search(self._msg['to'])
         if receiver:
             self.receiver = receiver.group()
-        for part in self._msg.walk():
-            filename = part.get_filename()
-            ctype = part.get_content_type()
-            if filename:
-                self.attachments.append((filename, ctype,
-                                    StringIO(part.get_payload(decode=True))))
-            else:
+
+    def _parse(self):
+        """
+        Extract bodies and attachments from the downloaded message
+        (see parse_parts), or take them from the parser.
+        The raw message isn't kept afterwards
+        """
+        started = time.time()
+        try:
+            self._parse_parts()
+        finally:
+            self.stats.timing('parse', time.time() - started)
+
+    def _parse_parts(self):
+        if self._parsed is not None:
+            self._text_bodies, self._html_bodies, attachments = \
+                self._parsed.get()
+            self._parsed = None
+            self._attachments = [(filename, ctype,
+                                  self._open_parsed(data, path))
+                                 for filename, ctype, data, path
+                                 in attachments]
+            return
+        self._text_bodies, self._html_bodies, self._attachments = \
+            parse_parts(self._raw, self._msg, self._spool)
+        self._raw = None
+
+    def _open_parsed(self, data, path):
+        """
+        File object of an attachment decoded by the parser
+        """
+        if path is None:
+            fileobj = tempfile.SpooledTemporaryFile(self.spool_size)
+            fileobj.write(data)
+            fileobj.seek(0)
+            return fileobj
+        fileobj = open(path, 'rb')
+        #The file is removed once it's closed
+        os.remove(path)
+        return fileobj
+
+    def _fetch(self, items):
+        status, response = self.session.uid('FETCH', self.uid, items)
+        if status != 'OK':
+            raise Exception(response)
+        fetched = parse_fetch(response)
+        if self.uid not in fetched:
+            raise Exception("Message %s not found" % self.uid)
+        return fetched[self.uid]
+
+    def _fetch_sections(self, sections):
+        """
+        Download the given body sections with a single command
+        """
+        if not sections:
+            return []
+        data = self._fetch('(UID %s)' % ' '.join(['BODY.PEEK[%s]' % section
+                                                  for section in sections]))
+        return [data.get('BODY[%s]' % section) or ''
+                for section in sections]
+
+    def wanted_parts(self, attachments=True):
+        """
+        Parts of a lazy message to download for its bodies and,
+        if `attachments` is set, attachments that aren't downloaded yet.
+        Returns (text parts, attachment parts) of its body structure
+        """
+        text_parts = []
+        if self._text_bodies is None:
+            text_parts = [part for part in self._parts if not part[2] and
+                          part[1] in ('text/plain', 'text/html')]
+        file_parts = []
+        if attachments and self._attachments is None:
+            file_parts = [part for part in self._parts if part[2]]
+        return text_parts, file_parts
+
+    def set_parts(self, text_parts, file_parts, payloads, attachments=False):
+        """
+        Take downloaded payloads of the parts, in the same order.
+        If `attachments` is set, `file_parts` are all the attachments
+        """
+        self.loaded_size += sum([len(payload) for payload in payloads])
+        text_payloads = payloads[:len(text_parts)]
+        file_payloads = payloads[len(text_parts):]
+        if self._text_bodies is None:
+            self._text_bodies = []
+            self._html_bodies = []
+            for (section, ctype, filename, encoding), payload in \
+                    zip(text_parts, text_payloads):
                 if ctype == 'text/plain':
-                    self.text_bodies.append(part.get_payload())
-                elif ctype == 'text/html':
-                    self.html_bodies.append(part.get_payload())
+                    self._text_bodies.append(payload)
+                else:
+                    self._html_bodies.append(payload)
+        if file_parts or attachments:
+            self._attachments = []
+            for (section, ctype, filename, encoding), payload in \
+                    zip(file_parts, file_payloads):
+                self._attachments.append((filename, ctype,
+                                          self._spool(payload, encoding)))
+
+    def _load_parts(self, attachments):
+        if self.parts_batch is not None and self.parts_batch.load(self):
+            if self._text_bodies is not None and \
+                    (not attachments or self._attachments is not None):
+                return
+        text_parts, file_parts = self.wanted_parts(attachments)
+        payloads = self._fetch_sections([part[0] for part
+                                         in text_parts + file_parts])
+        self.set_parts(text_parts, file_parts, payloads, attachments)
+
+    def _load_bodies(self):
+        if not self.lazy:
+            self._parse()
+            return
+        self._load_parts(False)
+
+    def _load_attachments(self):
+        if not self.lazy:
+            self._parse()
+            return
+        self._load_parts(True)
+
+    def _spool(self, payload, encoding):
+        """
+        Decoded payload as a file object, which is kept in memory until
+        it grows bigger than spool_size
+        """
+        fileobj = tempfile.SpooledTemporaryFile(self.spool_size)
+        decode_payload_to(payload, encoding, fileobj)
+        fileobj.seek(0)
+        return fileobj
+
+    @property
+    def text_bodies(self):
+        if self._text_bodies is None:
+            self._load_bodies()
+        return self._text_bodies
+
+    @property
+    def html_bodies(self):
+        if self._html_bodies is None:
+            self._load_bodies()
+        return self._html_bodies
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            self._load_attachments()
+        return self._attachments
 
     def __getitem__(self, name):
         return self._msg[name]
@@ -87,7 +748,10 @@ class Message(object):
         return "\n".join(self.text_bodies)
 
     def add_flag(self, flag):
-        self.session.uid('STORE', self.uid, '+FLAGS', flag)
+        if self.flag_batch is not None:
+            self.flag_batch.add(self.uid, flag)
+        else:
+            self.session.uid('STORE', self.uid, '+FLAGS', flag)
 
     def mark_as_read(self):
         self.add_flag(r'\Seen')
@@ -96,18 +760,46 @@ class Message(object):
         self.add_flag(r'\Deleted')
 
     def download(self):
-        #TODO: Ideally we shouldn't download the whole thing in order to parse
-        #headers.
-        pass
+        """
+        Make sure bodies and attachments of a lazy message are downloaded
+        """
+        self.text_bodies
+        self.attachments
 
 
 class MessageList(object):
 
-    def __init__(self, session, query):
+    def __init__(self, session, query, chunk_size=DEFAULT_CHUNK_SIZE,
+                 lazy=False, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_bytes=DEFAULT_CACHE_BYTES, after_uid=None,
+                 spool_size=DEFAULT_SPOOL_SIZE, parser=None, stats=None,
+                 chunk_bytes=DEFAULT_CHUNK_BYTES):
+        """
+        If `after_uid` is given, only messages with greater UIDs are listed.
+        Downloaded messages are parsed by `parser` (a ParserPool), if given.
+        Unless messages are lazy, sizes of a chunk of them are fetched
+        first and it's split into chunks of up to `chunk_bytes` bytes
+        """
         self.session = session
         self.query = query
-        self._cache = {}
+        self.after_uid = after_uid
+        if after_uid:
+            self.query = '(UID %d:* %s)' % (int(after_uid) + 1, query)
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.lazy = lazy
+        self.spool_size = spool_size
+        self.parser = parser
+        self.stats = stats
+        self._cache = LRUCache(cache_size, cache_bytes,
+                               lambda message: message.loaded_size)
         self._uids = None
+        self.flag_batch = None
+        self.parts_batch = None
+        if lazy:
+            self.parts_batch = PartsBatch(session)
+        #Called after every chunk of messages while iterating
+        self.on_chunk = None
 
     def _get_uids(self):
         charset = None #FIXME
@@ -115,6 +807,10 @@ class MessageList(object):
         if status != 'OK':
             raise Exception(data)
         self._uids = data[0].split()
+        if self.after_uid:
+            #'UID n:*' always matches the last message, even if its UID < n
+            self._uids = [uid for uid in self._uids
+                          if int(uid) > int(self.after_uid)]
 
     def __len__(self):
         if self._uids is None:
@@ -124,8 +820,12 @@ class MessageList(object):
     def __iter__(self):
         if self._uids is None:
             self._get_uids()
-        for uid in self._uids:
-            yield self.get(uid)
+        for chunk in self._chunks(self._uids):
+            for message in self.get_many(chunk):
+                yield message
+            self.flush()
+            if self.on_chunk:
+                self.on_chunk()
 
     def __getitem__(self, key):
         if not isinstance(key, (slice, int)):
@@ -133,39 +833,163 @@ class MessageList(object):
         if self._uids is None:
             self._get_uids()
         if isinstance(key, slice):
-            #TODO: Generator should be used here:
-            return [self.get(uid) for uid in self._uids[key]]
+            uids = self._uids[key]
+            messages = []
+            for chunk in self._chunks(uids):
+                messages.extend(self.get_many(chunk))
+            return messages
         else:
             return self.get(self._uids[key])
 
     def get(self, uid):
-        return self._cache.get(uid, Message(self.session, uid))
+        message = self._cache.get(uid)
+        if message is None:
+            message = Message(self.session, uid, lazy=self.lazy,
+                              spool_size=self.spool_size, parser=self.parser,
+                              stats=self.stats)
+            message.flag_batch = self.flag_batch
+            self._cache.set(uid, message)
+        return message
+
+    def batch_flags(self, expunge=False):
+        """
+        From now on, flags added to messages of the list are stored in
+        batches: after every chunk of messages while iterating
+        and on `flush`. If `expunge` is set, deleted messages are expunged
+        """
+        self.flag_batch = FlagBatch(self.session, expunge)
+
+    def flush(self):
+        """
+        Store flags added to messages since the last flush
+        """
+        if self.flag_batch is not None:
+            self.flag_batch.flush()
+
+    def get_many(self, uids):
+        """
+        Fetch several messages with a single UID FETCH command.
+        Cached messages aren't downloaded again.
+        Messages that vanished from the mailbox in the meantime are skipped
+        """
+        messages = {}
+        for uid in uids:
+            message = self._cache.get(uid)
+            if message is not None:
+                messages[uid] = message
+        missing = [uid for uid in uids if uid not in messages]
+        for message in self._fetch_many(missing):
+            self._cache.set(message.uid, message)
+            messages[message.uid] = message
+        return [messages[uid] for uid in uids if uid in messages]
+
+    def cache_info(self):
+        """
+        Cache statistics: hits, misses, number of cached messages and
+        their total size in bytes
+        """
+        return self._cache.info()
+
+    def _chunks(self, uids):
+        """
+        Split UIDs into chunks of up to chunk_size messages and, unless
+        messages are lazy, up to chunk_bytes bytes (a bigger message
+        makes a chunk of its own)
+        """
+        for start in range(0, len(uids), self.chunk_size):
+            chunk = uids[start:start + self.chunk_size]
+            missing = [uid for uid in chunk if uid not in self._cache]
+            if self.lazy or not self.chunk_bytes or len(missing) < 2:
+                yield chunk
+                continue
+            sizes = self._fetch_sizes(missing)
+            part = []
+            part_bytes = 0
+            for uid in chunk:
+                size = sizes.get(uid, 0)
+                if part and part_bytes + size > self.chunk_bytes:
+                    yield part
+                    part = []
+                    part_bytes = 0
+                part.append(uid)
+                part_bytes += size
+            if part:
+                yield part
+
+    def _fetch_sizes(self, uids):
+        status, data = self.session.uid('FETCH', uid_set(uids),
+                                        '(UID RFC822.SIZE)')
+        if status != 'OK':
+            raise Exception(data)
+        return dict([(uid, int(items.get('RFC822.SIZE') or 0))
+                     for uid, items in parse_fetch(data).items()])
+
+    def _fetch_many(self, uids):
+        if not uids:
+            return []
+        if self.lazy:
+            items = LAZY_FETCH_ITEMS
+        else:
+            items = EAGER_FETCH_ITEMS
+        status, data = self.session.uid('FETCH', uid_set(uids), items)
+        if status != 'OK':
+            raise Exception(data)
+        fetched = parse_fetch(data)
+        messages = [Message(self.session, uid, fetched[uid], self.lazy,
+                            self.spool_size, self.parser, self.stats)
+                    for uid in uids if uid in fetched]
+        for message in messages:
+            message.flag_batch = self.flag_batch
+            message.parts_batch = self.parts_batch
+        return messages
 
 
 class ImapClient(object):
 
     headers_format = '(RFC822)'
 
-    def __init__(self, host, username, password, port=None, ssl=False):
+    def __init__(self, host, username, password, port=None, ssl=False,
+                 chunk_size=DEFAULT_CHUNK_SIZE, lazy=False,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 cache_bytes=DEFAULT_CACHE_BYTES,
+                 spool_size=DEFAULT_SPOOL_SIZE, parser=None, stats=None,
+                 chunk_bytes=DEFAULT_CHUNK_BYTES):
+        """
+        Duration of IMAP commands is recorded in `stats` (a stats.Stats)
+        """
         self.host = host
         self.username = username
         self.password = password
         self.port = port
         self.ssl = ssl
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.spool_size = spool_size
+        self.parser = parser
+        if stats is None:
+            stats = NullStats()
+        self.stats = stats
         self._connection = None
         self.logged_in = False
         self.mailbox = None
+        self.uidvalidity = None
         self.echo = False
 
     def connect(self):
         if self.ssl:
             default_port = 993
-            cls = imaplib.IMAP4_SSL
+            cls = StatsIMAP4_SSL
         else:
             default_port = 143
-            cls = imaplib.IMAP4
+            cls = StatsIMAP4
         port = self.port or default_port
+        started = time.time()
         self._connection = cls(self.host, port)
+        self._connection.stats = self.stats
+        self.stats.timing('imap.connect', time.time() - started)
 
     @property
     def connection(self):
@@ -175,31 +999,144 @@ class ImapClient(object):
 
     def login(self, username, password):
         self.connection.login(username, password)
+        self.logged_in = True
 
     def select(self, mailbox='INBOX'):
         if not self.logged_in: #TODO: Maybe general 'state' would be better
             self.login(self.username, self.password)
         if self.mailbox:
             self.connection.close()
-        self.connection.select(mailbox)
+        status, data = self.connection.select(mailbox)
+        if status != 'OK':
+            raise Exception(data)
         self.mailbox = mailbox
+        status, data = self.connection.response('UIDVALIDITY')
+        self.uidvalidity = data and data[0] or None
+        #Messages that exist now are found by the search that follows
+        self.announced()
 
-    def search(self, query):
+    def announced(self):
+        """
+        Whether new messages were announced in replies to previous
+        commands (e.g. to storing flags), forgets the announcements
+        """
+        announced = False
+        for name in NEW_MAIL_RESPONSES:
+            if self.connection.untagged_responses.pop(name, None):
+                announced = True
+        return announced
+
+    def search(self, query, after_uid=None):
         if not self.mailbox:
             self.select()
-        return MessageList(self.connection, query)
+        return MessageList(self.connection, query, self.chunk_size,
+                           self.lazy, self.cache_size, self.cache_bytes,
+                           after_uid, self.spool_size, self.parser,
+                           self.stats, self.chunk_bytes)
+
+    def all(self, after_uid=None):
+        return self.search('ALL', after_uid)
+
+    def unseen(self, after_uid=None):
+        return self.search('UNSEEN', after_uid)
 
-    def all(self):
-        return self.search('ALL')
+    def nondeleted(self, after_uid=None):
+        return self.search('(NOT DELETED)', after_uid)
 
-    def unseen(self):
-        return self.search('UNSEEN')
+    def deleted(self, after_uid=None):
+        return self.search('(DELETED)', after_uid)
 
-    def nondeleted(self):
-        return self.search('(NOT DELETED)')
+    def idle(self, interval=DEFAULT_IDLE_INTERVAL,
+             poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        Wait up to `interval` seconds for the server to announce new
+        messages in the selected mailbox.
+        Uses IDLE command (RFC 2177) if the server supports it, otherwise
+        polls with NOOP every `poll_interval` seconds.
+        Returns True if new messages were announced.
+        Raises imaplib.IMAP4.abort if the connection is broken
+        """
+        if not self.mailbox:
+            self.select()
+        if self.announced():
+            return True
+        connection = self.connection
+        if 'IDLE' not in connection.capabilities:
+            return self._poll(interval, poll_interval)
+        tag = connection._new_tag()
+        try:
+            connection.send('%s IDLE\r\n' % tag)
+            line = connection.readline()
+            if not line.startswith('+'):
+                raise connection.abort('IDLE rejected: %r' % line)
+            announced = False
+            deadline = time.time() + interval
+            while not announced:
+                #Lines received along with the previous ones are read first
+                if not buffered(connection):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    if not select.select([connection.socket()], [], [],
+                                         remaining)[0]:
+                        break
+                line = connection.readline()
+                if not line or line.startswith('* BYE'):
+                    raise connection.abort('connection closed during IDLE')
+                if NEW_MAIL_EXPR.match(line):
+                    announced = True
+            connection.send('DONE\r\n')
+            while True:
+                line = connection.readline()
+                if not line:
+                    raise connection.abort('connection closed during IDLE')
+                if line.startswith(tag):
+                    break
+                if NEW_MAIL_EXPR.match(line):
+                    announced = True
+            if line.split(' ', 2)[1] != 'OK':
+                raise connection.abort('IDLE failed: %r' % line)
+            return announced
+        finally:
+            #imaplib forgets tags of its own commands once they complete
+            connection.tagged_commands.pop(tag, None)
+
+    def _poll(self, interval, poll_interval):
+        deadline = time.time() + interval
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(poll_interval, remaining))
+            self.connection.noop()
+            if self.announced():
+                return True
+
+    def reset(self):
+        """
+        Drop the connection (e.g. a broken one),
+        the next command connects and logs in again
+        """
+        if self._connection:
+            try:
+                self._connection.shutdown()
+            except Exception:
+                pass
+        self._connection = None
+        self.logged_in = False
+        self.mailbox = None
 
-    def deleted(self):
-        return self.search('(DELETED)')
+    def disconnect(self):
+        """
+        Log out without closing the mailbox
+        (which would expunge deleted messages)
+        """
+        if self._connection:
+            try:
+                self._connection.logout()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+        self.reset()
 
     def close(self):
         self.connection.close()
@@ -6,15 +6,36 @@ Mailpost version 0.1
 
 
 import os
+import sys
+from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.core.mail import mail_admins
 
 from mailpost.handler import Handler
+from mailpost.profiling import Profiler
 
 
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('--daemon', action='store_true', dest='daemon',
+                    default=False,
+                    help='Keep running and process new messages '
+                         'as they arrive'),
+        make_option('--stats', dest='stats', metavar='FILE',
+                    help='Write timings and counters of the run to FILE '
+                         'as JSON ("-" for standard output)'),
+        make_option('--profile', dest='profile', metavar='FILE',
+                    help='Profile the run with cProfile, save the results '
+                         'to FILE and print the hot functions'),
+        make_option('--profile-memory', action='store_true',
+                    dest='profile_memory', default=False,
+                    help='With --profile, trace allocations as well and '
+                         'print the top allocation sites '
+                         '(requires tracemalloc)'),
+    )
+
     def handle(self, *args, **options):
         if settings.DISABLE_FETCHMAIL:
             print "Fetchmail is disabled"
@@ -32,15 +53,43 @@ class Command(BaseCommand):
             return False
 
         handler = Handler(config_file=settings.MAILPOST_CONFIG_FILE)
+        profiler = None
+        if options.get('profile'):
+            try:
+                profiler = Profiler(options['profile'],
+                                    options.get('profile_memory'))
+            except ImportError, e:
+                raise CommandError(str(e))
 
         f = open(settings.LOCK_FILENAME, 'w')
         f.close()
+        if profiler:
+            profiler.start()
         try:
-            for url, result in handler.process():
+            if options.get('daemon'):
+                results = handler.serve()
+            else:
+                results = handler.process()
+            for url, result in results:
                 print 'Sent to URL: %s' % url
                 if isinstance(result, Exception):
                     print 'Error: ', result
                 else:
                     print 'OK'
         finally:
+            if profiler:
+                profiler.stop()
+                profiler.report()
             os.remove(settings.LOCK_FILENAME)
+            if options.get('stats'):
+                self.write_stats(handler.stats, options['stats'])
+
+    def write_stats(self, stats, filename):
+        if filename == '-':
+            stats.dump(sys.stdout)
+            return
+        f = open(filename, 'w')
+        try:
+            stats.dump(f)
+        finally:
+            f.close()
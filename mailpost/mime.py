@@ -0,0 +1,109 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import email
+
+#Characters that may follow a boundary delimiter on its line
+DELIMITER_END = ('\r', '\n', ' ', '\t', '-')
+
+
+def split_headers(raw, start=0, end=None):
+    """
+    Returns offset of the body of an entity (just after the blank line
+    that ends its headers), `end` if there's no body
+    """
+    if end is None:
+        end = len(raw)
+    if raw.startswith('\r\n', start, end):
+        return start + 2
+    if raw.startswith('\n', start, end):
+        return start + 1
+    offsets = []
+    for separator in ['\n\n', '\n\r\n']:
+        found = raw.find(separator, start, end)
+        if found >= 0:
+            offsets.append(found + len(separator))
+    if not offsets:
+        return end
+    return min(offsets)
+
+
+def split_multipart(raw, start, end, boundary):
+    """
+    Returns a list of (start, end) offsets of body parts of a multipart
+    entity, whose body is raw[start:end]. Preamble and epilogue are skipped.
+    A missing close delimiter is tolerated, like in email package
+    """
+    delimiter = '--' + boundary
+    parts = []
+    part_start = None
+    pos = start
+    while True:
+        found = raw.find(delimiter, pos, end)
+        if found < 0:
+            break
+        after = found + len(delimiter)
+        pos = after
+        #Delimiter must be at the beginning of a line and can't be
+        #a prefix of something else
+        if found > start and raw[found - 1] != '\n':
+            continue
+        if after < end and raw[after] not in DELIMITER_END:
+            continue
+        if part_start is not None:
+            #Line break before the delimiter belongs to the delimiter
+            part_end = found
+            if part_end > part_start and raw[part_end - 1] == '\n':
+                part_end -= 1
+            if part_end > part_start and raw[part_end - 1] == '\r':
+                part_end -= 1
+            parts.append((part_start, part_end))
+        if raw.startswith('--', after, end):
+            return parts
+        line_end = raw.find('\n', after, end)
+        if line_end < 0:
+            return parts
+        part_start = pos = line_end + 1
+    if part_start is not None and part_start < end:
+        #Last line break is dropped too, like in email package
+        part_end = end
+        if raw[part_end - 1] == '\n':
+            part_end -= 1
+        if part_end > part_start and raw[part_end - 1] == '\r':
+            part_end -= 1
+        parts.append((part_start, part_end))
+    return parts
+
+
+def walk_parts(raw, start=0, end=None, headers=None):
+    """
+    Yields (headers, body_start, body_end) for every leaf part of a raw
+    message, where `headers` is an email.Message with headers of the part
+    and raw[body_start:body_end] is its (still encoded) body.
+    Only headers are parsed, bodies are neither copied nor kept, so that
+    parts that aren't needed cost nothing.
+    `headers` of the entity itself may be given, if they are parsed already
+    """
+    if end is None:
+        end = len(raw)
+    body_start = split_headers(raw, start, end)
+    if headers is None:
+        headers = email.message_from_string(raw[start:body_start])
+    if headers.get_content_maintype() == 'multipart':
+        boundary = headers.get_boundary()
+        if boundary:
+            for part_start, part_end in split_multipart(raw, body_start, end,
+                                                        boundary):
+                for part in walk_parts(raw, part_start, part_end):
+                    yield part
+            return
+    elif headers.get_content_type() == 'message/rfc822':
+        #Parts of an attached message are walked, like in email package
+        for part in walk_parts(raw, body_start, end):
+            yield part
+        return
+    yield headers, body_start, end
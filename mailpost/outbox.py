@@ -0,0 +1,197 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib2
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+#How many times a delivery is attempted before it's given up
+DEFAULT_MAX_ATTEMPTS = 10
+#Delay (in seconds) before the first retry, it's doubled for every next one
+DEFAULT_RETRY_DELAY = 60
+DEFAULT_MAX_RETRY_DELAY = 3600
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def is_transient(error):
+    """
+    Whether a failed delivery is worth retrying: the receiver
+    couldn't be reached or answered with a server error
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, urllib2.URLError)
+
+
+class FileBody(object):
+    """
+    Request body read from a file in blocks,
+    can be sent again after `reset`
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        while True:
+            block = self.fileobj.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+    def reset(self):
+        self.fileobj.seek(0)
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Outbox(object):
+    """
+    Deliveries that failed with a transient error, kept in a directory
+    (a sqlite database and a file with the body of every request),
+    so that they are retried later, by this run or by the next ones.
+    Retries are delayed exponentially: `retry_delay`, twice that, four
+    times that... up to `max_retry_delay` seconds, with random jitter,
+    so that deliveries queued together aren't all retried at once
+    """
+
+    def __init__(self, directory, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY,
+                 max_retry_delay=DEFAULT_MAX_RETRY_DELAY):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'outbox.db'),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS deliveries ('
+                         'id INTEGER PRIMARY KEY, '
+                         'url TEXT, '
+                         'headers TEXT, '
+                         'auth TEXT, '
+                         'attempts INTEGER, '
+                         'next_attempt REAL, '
+                         'error TEXT)')
+        self._db.commit()
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM deliveries')[0][0]
+
+    def delay(self, attempts):
+        """
+        Seconds to wait before the next attempt,
+        after `attempts` failed ones
+        """
+        delay = min(self.retry_delay * 2 ** (attempts - 1),
+                    self.max_retry_delay)
+        return delay * random.uniform(0.5, 1)
+
+    def add(self, request, options, error):
+        """
+        Queue a request that failed for the first time.
+        `options` are options of the rule, 'auth' is kept to log in again.
+        Its URL should be absolute already
+        """
+        auth_data = options.get('auth', None)
+        if auth_data is not None:
+            auth_data = json.dumps(auth_data)
+        headers = json.dumps(dict(request.header_items()))
+        data = request.get_data()
+        self._lock.acquire()
+        try:
+            cursor = self._db.execute(
+                'INSERT INTO deliveries '
+                '(url, headers, auth, attempts, next_attempt, error) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (request.get_full_url(), headers, auth_data, 1,
+                 time.time() + self.delay(1), str(error)))
+            delivery_id = cursor.lastrowid
+            body = open(self._body_file(delivery_id), 'wb')
+            try:
+                if isinstance(data, basestring):
+                    body.write(data)
+                elif data is not None:
+                    if hasattr(data, 'reset'):
+                        data.reset()
+                    for chunk in data:
+                        body.write(chunk)
+            finally:
+                body.close()
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        finally:
+            self._lock.release()
+        return delivery_id
+
+    def next_attempt(self):
+        """
+        Time of the earliest retry, None if the outbox is empty
+        """
+        return self._execute('SELECT MIN(next_attempt) FROM deliveries')[0][0]
+
+    def retry(self, post, now=None):
+        """
+        Send again deliveries that are due with `post(request, options)`,
+        which returns the response body or the error.
+        Delivered ones are removed, failed ones are delayed again or given
+        up after `max_attempts`. Yields (url, result)
+        """
+        if now is None:
+            now = time.time()
+        due = self._execute('SELECT id, url, headers, auth, attempts '
+                            'FROM deliveries WHERE next_attempt <= ? '
+                            'ORDER BY next_attempt', (now,))
+        for delivery_id, url, headers, auth_data, attempts in due:
+            options = {}
+            if auth_data:
+                options['auth'] = json.loads(auth_data)
+            body = FileBody(open(self._body_file(delivery_id), 'rb'))
+            try:
+                request = urllib2.Request(url, body, json.loads(headers))
+                result = post(request, options)
+            finally:
+                body.close()
+            attempts += 1
+            if isinstance(result, Exception) and is_transient(result) and \
+                    attempts < self.max_attempts:
+                self._execute('UPDATE deliveries SET attempts = ?, '
+                              'next_attempt = ?, error = ? WHERE id = ?',
+                              (attempts, time.time() + self.delay(attempts),
+                               str(result), delivery_id))
+            else:
+                self._execute('DELETE FROM deliveries WHERE id = ?',
+                              (delivery_id,))
+                os.remove(self._body_file(delivery_id))
+            yield url, result
+
+    def close(self):
+        self._db.close()
+
+    def _body_file(self, delivery_id):
+        return os.path.join(self.directory, '%d.body' % delivery_id)
+
+    def _execute(self, query, params=()):
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(query, params).fetchall()
+            self._db.commit()
+            return rows
+        finally:
+            self._lock.release()
@@ -0,0 +1,109 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import sys
+import threading
+import Queue
+
+#Marks the end of items put into a queue by `prefetch`
+DONE = object()
+
+
+def wait_for(queue):
+    """
+    Get an item from the queue, waiting for it as long as needed.
+    Unlike queue.get(), it can be interrupted by KeyboardInterrupt
+    """
+    while True:
+        try:
+            return queue.get(True, 1)
+        except Queue.Empty:
+            pass
+
+
+def prefetch(items, size):
+    """
+    Iterate over `items` in a separate thread, up to `size` items ahead of
+    the consumer, so that producing the next items (like downloading
+    messages) overlaps with consuming the previous ones (like posting them).
+    Exceptions raised by the producer are raised by the consumer
+    """
+    queue = Queue.Queue(size)
+    stopped = threading.Event()
+
+    def run():
+        try:
+            for item in items:
+                queue.put((item, None))
+                if stopped.isSet():
+                    break
+        except Exception:
+            queue.put((DONE, sys.exc_info()))
+        else:
+            queue.put((DONE, None))
+
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        while True:
+            item, exc_info = wait_for(queue)
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is DONE:
+                break
+            yield item
+    finally:
+        stopped.set()
+        #The producer may be waiting for room in the queue
+        while thread.isAlive():
+            try:
+                queue.get(True, 0.1)
+            except Queue.Empty:
+                pass
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads calling `func` for submitted jobs.
+    For every job (tag, result, exc_info) is put into `results` queue,
+    where `tag` is whatever was submitted along with the job
+    """
+
+    def __init__(self, func, size, results):
+        self.func = func
+        self.size = size
+        self.results = results
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for num in range(size):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, tag, *args):
+        self._jobs.put((tag, args))
+
+    def close(self, wait=True):
+        for thread in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            tag, args = job
+            try:
+                self.results.put((tag, self.func(*args), None))
+            except Exception:
+                self.results.put((tag, None, sys.exc_info()))
@@ -0,0 +1,104 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import cProfile
+import pstats
+import sys
+import threading
+try:
+    import tracemalloc
+except ImportError:
+    #Comes with Python 3.4, Python 2 needs pytracemalloc
+    tracemalloc = None
+
+#How many functions and allocation sites are reported
+DEFAULT_LIMIT = 20
+
+
+class Profiler(object):
+    """
+    cProfile of a run, saved to `filename` (to be loaded with pstats).
+    If `memory` is set, allocations are traced with tracemalloc as well,
+    the final snapshot is saved to `filename`.memory and sites that
+    allocated most since `start` are reported.
+    The thread that started the profiler and threads started after it
+    (like worker pools) are profiled, each one with its own cProfile,
+    and the results of all of them are merged
+    """
+
+    def __init__(self, filename, memory=False):
+        if memory and tracemalloc is None:
+            raise ImportError('tracemalloc is required to profile memory')
+        self.filename = filename
+        self.memory = memory
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._allocations = []
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+        threading.setprofile(self._start_thread)
+        self._profile.enable()
+
+    def _start_thread(self, frame, event, arg):
+        """
+        Called by a new thread on its first event, replaces itself
+        with a cProfile of the thread
+        """
+        profile = cProfile.Profile()
+        self._lock.acquire()
+        try:
+            self._thread_profiles.append(profile)
+        finally:
+            self._lock.release()
+        profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling and save the results.
+        Threads that are still running are profiled until they stop,
+        what they did so far is saved
+        """
+        self._profile.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self._profile)
+        self._lock.acquire()
+        try:
+            for profile in self._thread_profiles:
+                profile.create_stats()
+                #pstats refuses profiles without any calls
+                if profile.stats:
+                    stats.add(profile)
+            self._thread_profiles = []
+        finally:
+            self._lock.release()
+        stats.dump_stats(self.filename)
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(self.filename + '.memory')
+            self._allocations = snapshot.compare_to(self._snapshot, 'lineno')
+            self._snapshot = None
+
+    def report(self, stream=None, limit=DEFAULT_LIMIT):
+        """
+        Print functions that took most time by themselves and including
+        what they called, and the top allocation sites
+        """
+        if stream is None:
+            stream = sys.stdout
+        stats = pstats.Stats(self.filename, stream=stream)
+        stats.sort_stats('time').print_stats(limit)
+        stats.sort_stats('cumulative').print_stats(limit)
+        if self.memory:
+            print >> stream, 'Top allocation sites:'
+            for allocation in self._allocations[:limit]:
+                print >> stream, allocation
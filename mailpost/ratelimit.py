@@ -0,0 +1,168 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import threading
+import time
+import urllib2
+from email.utils import parsedate_tz, mktime_tz
+
+#Responses that ask to slow down
+THROTTLE_CODES = (429, 503)
+#Longest pause (in seconds) after a throttling response
+DEFAULT_MAX_PAUSE = 300
+#Rate isn't lowered by adaptive slowdown below that share of the limit
+MIN_RATE_SHARE = 0.1
+
+
+def retry_after(error):
+    """
+    Seconds to wait according to Retry-After header of a HTTPError
+    (either a number of seconds or a date), None if it isn't given
+    """
+    headers = error.info()
+    value = headers and headers.get('Retry-After', None)
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` acquisitions per second on average and up to `burst`
+    of them at once
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for it as long as needed
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+
+class Limiter(object):
+    """
+    Limits requests to an endpoint: at most `rate` requests per second
+    (with bursts of `burst`) and `max_in_flight` at the same time.
+    Responses with 429 or 503 pause all the requests for the time given
+    by Retry-After, or 1, 2, 4... up to `max_pause` seconds without it,
+    and halve the rate. The rate is restored gradually by successful
+    requests
+    """
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None,
+                 max_pause=DEFAULT_MAX_PAUSE):
+        self.rate = rate
+        self.max_pause = max_pause
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst)
+        self.slots = None
+        if max_in_flight:
+            self.slots = threading.Semaphore(max_in_flight)
+        self.paused_until = 0
+        self.backoff = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            wait = self.paused_until - time.time()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        if self.bucket:
+            self.bucket.acquire()
+        if self.slots:
+            self.slots.acquire()
+
+    def release(self, result):
+        """
+        Give back the slot of a request, slow down if its `result`
+        (a response body or URLError, None if the request failed with
+        another error) asks for it.
+        Returns True if it did
+        """
+        if self.slots:
+            self.slots.release()
+        self._lock.acquire()
+        try:
+            if isinstance(result, urllib2.HTTPError) and \
+                    result.code in THROTTLE_CODES:
+                self._slow_down(retry_after(result))
+                return True
+            if result is None or isinstance(result, Exception):
+                return False
+            self.backoff = 0
+            if self.bucket and self.bucket.rate < self.rate:
+                self.bucket.rate = min(self.rate, self.bucket.rate +
+                                       self.rate * MIN_RATE_SHARE)
+            return False
+        finally:
+            self._lock.release()
+
+    def _slow_down(self, delay):
+        if delay is None:
+            self.backoff = min(max(1, 2 * self.backoff), self.max_pause)
+            delay = self.backoff
+        delay = min(delay, self.max_pause)
+        self.paused_until = max(self.paused_until, time.time() + delay)
+        if self.bucket:
+            self.bucket.rate = max(self.bucket.rate / 2,
+                                   self.rate * MIN_RATE_SHARE)
+
+
+class HostLimits(object):
+    """
+    A Limiter for every host, all of them with the same limits.
+    Without `rate` and `max_in_flight`, hosts are only paused when they
+    ask to slow down
+    """
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None,
+                 max_pause=DEFAULT_MAX_PAUSE):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_pause = max_pause
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self._limiters:
+                self._limiters[host] = Limiter(self.rate, self.burst,
+                                               self.max_in_flight,
+                                               self.max_pause)
+            return self._limiters[host]
+        finally:
+            self._lock.release()
@@ -0,0 +1,133 @@
+"""
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+import re
+import socket
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+#Characters that can't be a part of a metric name
+NAME_EXPR = re.compile(r'[^\w.-]')
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_STATSD_PREFIX = 'mailpost'
+
+
+def metric_name(*parts):
+    """
+    Dotted metric name, characters that aren't allowed (like '/' or '@'
+    of mailbox names) are replaced with '_'
+    """
+    return '.'.join([NAME_EXPR.sub('_', str(part)) for part in parts])
+
+
+class NullStats(object):
+    """
+    Stats that record nothing, used when no stats are given
+    """
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+
+class Stats(object):
+    """
+    Counters and durations (in seconds) of stages of processing,
+    recorded by any thread.
+    Every value is passed to `exporters` as well (like StatsdExporter),
+    which have the same `incr` and `timing` methods
+    """
+
+    def __init__(self, exporters=None):
+        self.exporters = exporters or []
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+        for exporter in self.exporters:
+            exporter.incr(name, value)
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            timing = self.timings.get(name, None)
+            if timing is None:
+                timing = self.timings[name] = {'count': 0, 'total': 0.0,
+                                               'max': 0.0}
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+        finally:
+            self._lock.release()
+        for exporter in self.exporters:
+            exporter.timing(name, seconds)
+
+    def summary(self):
+        """
+        Counters and timings (count, total, average and max seconds)
+        """
+        self._lock.acquire()
+        try:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = dict(timing,
+                                     average=timing['total'] / timing['count'])
+            return {'counters': dict(self.counters), 'timings': timings}
+        finally:
+            self._lock.release()
+
+    def dump(self, fileobj):
+        """
+        Write the summary as JSON
+        """
+        json.dump(self.summary(), fileobj, indent=2, sort_keys=True)
+        fileobj.write('\n')
+
+
+class StatsdExporter(object):
+    """
+    Sends values to a StatsD server over UDP as they are recorded,
+    like 'mailpost.post:25.100|ms' or 'mailpost.post.bytes:1024|c'.
+    Errors are ignored, like lost packets are
+    """
+
+    def __init__(self, host='localhost', port=DEFAULT_STATSD_PORT,
+                 prefix=DEFAULT_STATSD_PREFIX):
+        self.address = (socket.gethostbyname(host), port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value=1):
+        self._send('%s:%d|c' % (self._name(name), value))
+
+    def timing(self, name, seconds):
+        self._send('%s:%.3f|ms' % (self._name(name), seconds * 1000))
+
+    def close(self):
+        self._socket.close()
+
+    def _name(self, name):
+        if self.prefix:
+            return '%s.%s' % (self.prefix, name)
+        return name
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self.address)
+        except socket.error:
+            pass
@@ -12,14 +12,42 @@ import urllib2
 import os
 import imaplib
 import email
+import socket
+import base64
+import quopri
+import shutil
+import tempfile
+import time
+import Queue
 from cStringIO import StringIO
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import unittest
 from mock import Mock
 
-from mailpost.fnmatch import fnmatch, fnmatchcase, translate
-from mailpost.imap import ImapClient, Message
-from mailpost.handler import Handler, Mapper
+from mailpost.fnmatch import fnmatch, fnmatchcase, translate, compile, \
+    purge, set_cache_size, cache_info, DEFAULT_CACHE_SIZE
+from mailpost.imap import ImapClient, Message, MessageList, ParserPool, \
+    PartsBatch, uid_set, parse_fetch, parse_bodystructure, decode_payload_to
+from mailpost.handler import Handler, Inbox, Mapper, Rule, \
+    ConfigurationError, compile_patterns, split_literal
+from mailpost.mime import split_headers, walk_parts
+from mailpost.checkpoint import CheckpointStore
+from mailpost.connections import ConnectionPool
+from mailpost.outbox import Outbox, is_transient
+from mailpost.auth import SessionCache
+from mailpost.pool import WorkerPool, prefetch
+from mailpost.stats import Stats, StatsdExporter, metric_name
+from mailpost.profiling import Profiler
+from mailpost.ratelimit import TokenBucket, Limiter, retry_after
+from mailposttest.benchmark import ImapServer, Mailbox, make_message
 
 
 class TestFnmatch(unittest.TestCase):
@@ -85,6 +113,27 @@ class TestFnmatch(unittest.TestCase):
         check('\*\*', '\*\*')
         check('\*\[[*]', '\*[*]', 0)
 
+    def test_compile(self):
+        pattern = compile('*@gmail.com')
+        self.assert_(pattern.match('test@gmail.com'))
+        self.assert_(not pattern.match('test@gmail.com.ua'))
+        self.assertEqual(pattern.filter(['a@gmail.com', 'b@odesk.com']),
+                         ['a@gmail.com'])
+        self.assert_(compile('*@gmail.com') is pattern)
+
+    def test_cache(self):
+        purge()
+        set_cache_size(2)
+        hits, misses = cache_info()['hits'], cache_info()['misses']
+        try:
+            for pattern in ['a*', 'b*', 'a*', 'c*', 'a*', 'b*']:
+                fnmatch('abc', pattern)
+            info = cache_info()
+            self.assertEqual((info['hits'] - hits, info['misses'] - misses,
+                              info['items']), (2, 4, 2))
+        finally:
+            set_cache_size(DEFAULT_CACHE_SIZE)
+
 string_message = '''from:TESTserveradministrator@gmail.com;
 to:TESTlillianc@gmail.com;
 subject:[AVAILABLE FOR TRANSLATION] A task in our server
@@ -151,3 +200,1191 @@ class TestMailPost(unittest.TestCase):
         mapper = Mapper(self.sample_rules, 'http://localhost:8000')
         mapping = mapper.map(self.message)
         assert 'Message-ID' in mapping[1]['msg_params']
+
+    def test_worker_pool(self):
+        sent = []
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                sent.append(request.get_full_url())
+                return 'ok'
+
+        done = []
+        messages = [Message(self.sessionmock, uid) for uid in range(10)]
+        for rules, workers in [(self.sample_rules, 4),
+                               ([dict(self.sample_rules[0], workers=2)], 0)]:
+            mapper = TestMapper(rules, 'http://localhost:8000', workers)
+            results = list(mapper.process(messages, done.append))
+            self.assertEqual(results,
+                             [('http://localhost:8000/upload_email/', 'ok')] *
+                             len(messages))
+        self.assertEqual(len(sent), 2 * len(messages))
+        self.assertEqual(sorted([message.uid for message in done]),
+                         sorted(range(10) * 2))
+
+    def test_failed_not_done(self):
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                if request.get_full_url().endswith('/fail/'):
+                    return urllib2.URLError('refused')
+                if request.get_full_url().endswith('/reject/'):
+                    return urllib2.HTTPError(request.get_full_url(), 400,
+                                             'Bad Request', {}, None)
+                return 'ok'
+
+        messages = [Message(self.sessionmock, uid) for uid in range(3)]
+        for url in ['/fail/', '/reject/', '/ok/']:
+            done = []
+            mapper = TestMapper([dict(self.sample_rules[0], url=url)],
+                                'http://localhost:8000')
+            self.assertEqual(len(list(mapper.process(messages,
+                                                     done.append))), 3)
+            self.assertEqual(len(done), url != '/fail/' and 3 or 0)
+        #Queued in the outbox
+        mapper.outbox = Mock()
+        mapper.rules[0].url = 'http://localhost:8000/fail/'
+        done = []
+        list(mapper.process(messages, done.append))
+        self.assertEqual(len(done), 3)
+
+    def test_deferred_actions(self):
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                if request.get_full_url().endswith('/fail/'):
+                    return urllib2.URLError('refused')
+                return 'ok'
+
+        read = []
+        messages = [Message(self.sessionmock, uid) for uid in range(2)]
+        for message in messages:
+            message.mark_as_read = lambda uid=message.uid: read.append(uid)
+        rules = [dict(self.sample_rules[0], url='/fail/',
+                      defer_actions=True),
+                 dict(self.sample_rules[0], defer_actions=True)]
+        for workers in [0, 2]:
+            mapper = TestMapper(rules, 'http://localhost:8000', workers)
+            list(mapper.process(messages[:1]))
+            self.assertEqual(read, [])
+            mapper = TestMapper(rules[1:], 'http://localhost:8000', workers)
+            list(mapper.process(messages[1:]))
+            self.assertEqual(read, [1])
+            del read[:]
+            #Queued in the outbox to be retried
+            mapper = TestMapper(rules[:1], 'http://localhost:8000', workers)
+            mapper.outbox = Mock()
+            list(mapper.process(messages[:1]))
+            self.assertEqual(read, [0])
+            del read[:]
+
+    def test_batches(self):
+        sent = []
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                body = ''.join(request.get_data())
+                sent.append(body.count('name="message[') / 2)
+                if sent[-1] == 3:
+                    assert 'name="message[1][subject]"' in body
+                    assert body.count('name="message_type"') == 1
+                    return '[true, {"error": "spam"}, {"id": 3}]'
+                return 'ok'
+
+        read = []
+        messages = [Message(self.sessionmock, uid) for uid in range(5)]
+        for message in messages:
+            message.mark_as_read = lambda uid=message.uid: read.append(uid)
+        rules = [dict(self.sample_rules[0], batch_size=3,
+                      msg_params=['subject', 'Message-ID'],
+                      defer_actions=True)]
+        for workers in [0, 2]:
+            del sent[:]
+            del read[:]
+            done = []
+            mapper = TestMapper(rules, 'http://localhost:8000', workers)
+            results = [result for url, result
+                       in mapper.process(messages, done.append)]
+            #With workers, batches are posted in any order
+            self.assertEqual(sorted(sent), [2, 3])
+            errors = [result for result in results
+                      if isinstance(result, Exception)]
+            self.assertEqual([error.item for error in errors],
+                             [{'error': 'spam'}])
+            self.assertEqual(sorted([result for result in results
+                                     if result not in errors]),
+                             sorted([True, {'id': 3}, 'ok', 'ok']))
+            self.assertEqual(sorted(read), [0, 2, 3, 4])
+            self.assertEqual(len(done), 5)
+
+    def test_formats(self):
+        sent = []
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                sent.append(request)
+                return 'ok'
+
+        rule = dict(self.sample_rules[0], format='json', send_files=False,
+                    msg_params=['subject', 'Message-ID'])
+        mapper = Mapper([rule], 'http://localhost:8000')
+        request = mapper.prepare(self.message, *mapper.map(self.message))
+        self.assertEqual(request.get_header('Content-type'),
+                         'application/json')
+        data = json.loads(request.get_data())
+        self.assertEqual(data['message_type'], 'test')
+        self.assertEqual(data['subject'], self.message['subject'])
+        request = mapper.prepare({'subject': '\xff'}, *mapper.map(
+            self.message))
+        self.assert_(request.get_header('Content-type').startswith(
+            'multipart/form-data'))
+
+        mapper = TestMapper([dict(rule, format='ndjson', batch_size=2)],
+                            'http://localhost:8000')
+        list(mapper.process([self.message, self.message]))
+        self.assertEqual(sent[0].get_header('Content-type'),
+                         'application/x-ndjson')
+        lines = sent[0].get_data().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[1])['message_type'], 'test')
+        self.assertRaises(ConfigurationError, Mapper,
+                          [dict(rule, format='xml')])
+
+    def test_inboxes(self):
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                return 'ok'
+
+        class TestList(list):
+
+            def batch_flags(self, expunge=False):
+                pass
+
+            def flush(self):
+                pass
+
+        class TestHandler(Handler):
+
+            def load_backend(self):
+                self.imap_connections = 2
+                self.inboxes = inboxes
+                self.outbox = None
+                self.parser = None
+
+        mapper = TestMapper(self.sample_rules, 'http://localhost:8000')
+        inboxes = []
+        for name in ['INBOX', 'Support', 'Sales']:
+            client = Mock()
+            client.mailbox = None
+            client.all.return_value = TestList(
+                [Message(self.sessionmock, uid) for uid in range(5)])
+            inboxes.append(Inbox(client, name, 'all', mapper))
+        results = list(TestHandler({'backend': 'imap'}).process())
+        self.assertEqual(len(results), 15)
+        for inbox in inboxes:
+            inbox.client.select.assert_called_with(inbox.mailbox)
+            self.assert_(inbox.client.disconnect.called)
+
+    def test_accounts(self):
+        config = {
+            'backend': 'imap',
+            'host': 'imap.example.com',
+            'password': 'secret',
+            'rules': self.sample_rules,
+            'accounts': [
+                {'username': 'support', 'inboxes': ['INBOX', 'Billing']},
+                {'username': 'sales', 'host': 'imap.example.org',
+                 'base_url': 'http://localhost:8000'},
+            ],
+        }
+        handler = Handler(config)
+        handler.load_backend()
+        self.assertEqual([(inbox.client.username, inbox.client.host,
+                           inbox.mailbox) for inbox in handler.inboxes],
+                         [('support', 'imap.example.com', 'INBOX'),
+                          ('sales', 'imap.example.org', 'INBOX'),
+                          ('support', 'imap.example.com', 'Billing')])
+        self.assertEqual(handler.inboxes[1].mapper.rules[0].url,
+                         'http://localhost:8000/upload_email/')
+        config['accounts'].append({'username': 'info', 'backend': 'pop3'})
+        self.assertRaises(ConfigurationError, handler.load_backend)
+
+
+class TestRule(unittest.TestCase):
+
+    def test_compile_patterns(self):
+        match = compile_patterns(['*@gmail.com', '*@odesk.com'])
+        self.assert_(match('test@odesk.com'))
+        self.assert_(not match('test@odesk.com.ua'))
+        match = compile_patterns(r'\[AVAILABLE*')
+        self.assert_(match('[AVAILABLE FOR TRANSLATION]'))
+        match = compile_patterns([r'\d+@', 'test'], 'regexp')
+        self.assert_(match('123@gmail.com'))
+        self.assert_(match('tester'))
+        self.assert_(not match('john@gmail.com'))
+        #More groups than a single expression can hold
+        match = compile_patterns(['(a)(b)' * 30, '(c)' * 50], 'regexp')
+        self.assert_(match('c' * 50))
+        #Flags and backreferences apply to their own expression only
+        match = compile_patterns(['(?i)^vip', '^urgent'], 'regexp')
+        self.assert_(match('VIP'))
+        self.assert_(not match('URGENT'))
+        match = compile_patterns([r'(a)\1', r'(b)\1'], 'regexp')
+        self.assert_(match('aa'))
+        self.assert_(match('bb'))
+
+    def test_rule(self):
+        rule = Rule({'url': '/upload/', 'conditions': {'sender': '*@a.com'}},
+                    'http://localhost:8000/')
+        self.assertEqual(rule.url, 'http://localhost:8000/upload/')
+        self.assertEqual(rule['send_files'], True)
+        self.assertRaises(ConfigurationError, Rule, {})
+        self.assertRaises(ConfigurationError, Rule,
+                          {'url': '/', 'conditions': {'sender': 1}})
+
+    def test_split_literal(self):
+        self.assertEqual(split_literal('a@b.com'), ('exact', 'a@b.com'))
+        self.assertEqual(split_literal('*@b.com'), ('suffix', '@b.com'))
+        self.assertEqual(split_literal(r'\[ticket\*'), ('exact', '[ticket*'))
+        self.assertEqual(split_literal('*@b.*'), None)
+        self.assertEqual(split_literal('a?'), None)
+
+    def test_index(self):
+        mapper = Mapper([
+            {'url': '/0/', 'conditions': {'sender': '*@a.com'}},
+            {'url': '/1/', 'conditions': {'sender': 'x@b.com',
+                                          'subject': '*report*'}},
+            {'url': '/2/', 'conditions': {'sender': ['*@b.com', 'y@c.com']}},
+            {'url': '/3/', 'conditions': {'subject': '[*'}},
+            {'url': '/4/', 'conditions': {}},
+        ])
+        index = mapper.index
+        self.assertEqual(index.fallback, [3, 4])
+        self.assertEqual(index.candidates({'sender': 'x@b.com'}), [1, 2, 3, 4])
+        self.assertEqual(index.candidates({'sender': 'me@a.com'}), [0, 3, 4])
+        self.assertEqual(index.candidates({'sender': 'me@ba.com'}), [3, 4])
+        self.assertEqual(mapper.map({'sender': 'x@b.com',
+                                     'subject': 'weekly report'})[0], '/1/')
+        self.assertEqual(mapper.map({'sender': 'x@b.com',
+                                     'subject': 'hello'})[0], '/2/')
+        self.assertEqual(mapper.map({'sender': 'y@c.com'})[0], '/2/')
+        self.assertEqual(mapper.map({'sender': 'z@c.com',
+                                     'subject': '[1]'})[0], '/3/')
+        self.assertEqual(mapper.map({'sender': 'z@c.com'})[0], '/4/')
+
+
+class TestMessageList(unittest.TestCase):
+
+    def setUp(self):
+        self.sessionmock = Mock()
+        self.commands = []
+
+        def uid(command, *args):
+            self.commands.append((command, args))
+            if command == 'SEARCH':
+                return 'OK', ['1 2 3 5 8']
+            if command in ('STORE', 'EXPUNGE'):
+                return 'OK', []
+            # UID before the literal for odd UIDs, after it for even ones
+            data = []
+            for number in args[0].split(','):
+                if ':' in number:
+                    start, end = number.split(':')
+                    uids = range(int(start), int(end) + 1)
+                else:
+                    uids = [int(number)]
+                for uid in uids:
+                    if args[1] == '(UID RFC822.SIZE)':
+                        data.append('%d (UID %d RFC822.SIZE %d)' %
+                                    (uid, uid, uid * 100))
+                    elif uid % 2:
+                        data.append(('%d (UID %d BODY[] {100}' % (uid, uid),
+                                     string_message))
+                        data.append(')')
+                    else:
+                        data.append(('%d (BODY[] {100}' % uid,
+                                     string_message))
+                        data.append(' UID %d)' % uid)
+            return 'OK', data
+
+        self.sessionmock.uid = uid
+        self.sessionmock.capabilities = ('IMAP4REV1',)
+
+    def test_uid_set(self):
+        self.assertEqual(uid_set(['1', '2', '3', '7', '9', '10']),
+                         '1:3,7,9:10')
+        self.assertEqual(uid_set(['5']), '5')
+
+    def test_batched_fetch(self):
+        msg_list = MessageList(self.sessionmock, 'ALL', chunk_size=3)
+        messages = list(msg_list)
+        self.assertEqual([m.uid for m in messages], ['1', '2', '3', '5', '8'])
+        fetches = [args[0] for command, args in self.commands
+                   if command == 'FETCH' and 'BODY.PEEK[]' in args[1]]
+        self.assertEqual(fetches, ['1:3', '5,8'])
+        self.assertEqual(messages[-1]['Message-ID'], '123')
+
+    def test_chunk_bytes(self):
+        msg_list = MessageList(self.sessionmock, 'ALL', chunk_size=3,
+                               chunk_bytes=350)
+        self.assertEqual([m.uid for m in msg_list], ['1', '2', '3', '5', '8'])
+        fetches = [args for command, args in self.commands
+                   if command == 'FETCH']
+        #Sizes are fetched first, a message bigger than chunk_bytes
+        #is fetched on its own
+        self.assertEqual(fetches, [('1:3', '(UID RFC822.SIZE)'),
+                                   ('1:2', '(UID BODY.PEEK[])'),
+                                   ('3', '(UID BODY.PEEK[])'),
+                                   ('5,8', '(UID RFC822.SIZE)'),
+                                   ('5', '(UID BODY.PEEK[])'),
+                                   ('8', '(UID BODY.PEEK[])')])
+
+    def test_after_uid(self):
+        msg_list = MessageList(self.sessionmock, 'ALL', after_uid='3')
+        self.assertEqual([m.uid for m in msg_list], ['5', '8'])
+        self.assertEqual(self.commands[0], ('SEARCH', (None, '(UID 4:* ALL)')))
+
+    def test_cache(self):
+        msg_list = MessageList(self.sessionmock, 'ALL', chunk_size=3)
+        latest = msg_list[-2:]
+        messages = list(msg_list)
+        self.assert_(messages[-1] is latest[-1])
+        self.assert_(msg_list.get('1') is messages[0])
+        fetches = [args[0] for command, args in self.commands
+                   if command == 'FETCH']
+        #Sizes of cached messages aren't fetched
+        self.assertEqual(fetches, ['5,8', '5,8', '1:3', '1:3'])
+        info = msg_list.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['items']),
+                         (3, 5, 5))
+
+    def test_batched_flags(self):
+        self.sessionmock.expunge.return_value = 'OK', []
+        msg_list = MessageList(self.sessionmock, 'ALL', chunk_size=3)
+        msg_list.batch_flags(expunge=True)
+        for message in msg_list:
+            message.mark_as_read()
+            if message.uid != '2':
+                message.delete()
+        stores = [args for command, args in self.commands
+                  if command == 'STORE']
+        self.assertEqual(stores, [('1,3', '+FLAGS', r'\Deleted'),
+                                  ('1:3', '+FLAGS', r'\Seen'),
+                                  ('5,8', '+FLAGS', r'\Deleted'),
+                                  ('5,8', '+FLAGS', r'\Seen')])
+        self.assertEqual(self.sessionmock.expunge.call_count, 2)
+        #Only messages deleted here are expunged with UIDPLUS
+        self.sessionmock.capabilities = ('IMAP4REV1', 'UIDPLUS')
+        msg_list = MessageList(self.sessionmock, 'ALL', chunk_size=3)
+        msg_list.batch_flags(expunge=True)
+        for message in msg_list:
+            message.delete()
+        expunges = [args for command, args in self.commands
+                    if command == 'EXPUNGE']
+        self.assertEqual(expunges, [('1:3',), ('5,8',)])
+        self.assertEqual(self.sessionmock.expunge.call_count, 2)
+
+    def test_cache_bounds(self):
+        msg_list = MessageList(self.sessionmock, 'ALL', cache_size=2)
+        list(msg_list)
+        self.assertEqual(msg_list.cache_info()['items'], 2)
+        size = msg_list.get('8').loaded_size
+        msg_list = MessageList(self.sessionmock, 'ALL',
+                               cache_bytes=size * 3)
+        list(msg_list)
+        self.assertEqual(msg_list.cache_info()['items'], 3)
+
+
+lazy_headers = 'From: Test <test@gmail.com>\r\nTo: to@gmail.com\r\n' \
+               'Subject: Lazy\r\n\r\n'
+lazy_structure = '(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 5 ' \
+                 '1 NIL NIL NIL NIL)("APPLICATION" "PDF" ("NAME" "a.pdf") ' \
+                 'NIL NIL "BASE64" 8 NIL ' \
+                 '("ATTACHMENT" ("FILENAME" "b.pdf")) NIL NIL) ' \
+                 '"MIXED" ("BOUNDARY" "xyz") NIL NIL NIL)'
+
+
+class TestIdle(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ImapClient('localhost', 'user', 'password')
+        self.client.mailbox = 'INBOX'
+        self.connection = self.client._connection = Mock()
+        self.sent = []
+        self.connection.send = self.sent.append
+        self.connection.abort = imaplib.IMAP4.abort
+        self.connection.tagged_commands = {}
+
+        def new_tag():
+            self.connection.tagged_commands['A1'] = None
+            return 'A1'
+        self.connection._new_tag = new_tag
+        self.connection.untagged_responses = {}
+        self.connection.file = self.connection.sslobj = None
+        self.sockets = socket.socketpair()
+        self.connection.socket.return_value = self.sockets[0]
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def test_idle(self):
+        self.connection.capabilities = ('IMAP4REV1', 'IDLE')
+        lines = ['+ idling\r\n', '* 4 EXISTS\r\n', 'A1 OK done\r\n']
+        self.connection.readline = lambda: lines.pop(0)
+        self.sockets[1].send('x')
+        self.assert_(self.client.idle(5))
+        self.assertEqual(self.sent, ['A1 IDLE\r\n', 'DONE\r\n'])
+        #Nothing is announced until timeout
+        lines[:] = ['+ idling\r\n', 'A1 OK done\r\n']
+        self.sockets[0].recv(1)
+        self.assert_(not self.client.idle(0.01))
+        #Tags are forgotten, even if IDLE fails
+        lines[:] = ['A1 BAD unknown command\r\n']
+        self.assertRaises(imaplib.IMAP4.abort, self.client.idle, 5)
+        self.assertEqual(self.connection.tagged_commands, {})
+
+    def test_announced(self):
+        self.connection.capabilities = ('IMAP4REV1', 'IDLE')
+        #Announced in reply to a previous command
+        self.connection.untagged_responses = {'EXISTS': ['3']}
+        self.assert_(self.client.idle(5))
+        self.assertEqual(self.sent, [])
+        #Received along with the continuation, select() doesn't see it
+        lines = ['+ idling\r\n', '* 4 EXISTS\r\n', 'A1 OK done\r\n']
+        self.connection.file = Mock()
+        rbuf = self.connection.file._rbuf = StringIO()
+
+        def readline():
+            line = lines.pop(0)
+            rbuf.truncate(0)
+            rbuf.write(''.join(lines))
+            return line
+        self.connection.readline = readline
+        started = time.time()
+        self.assert_(self.client.idle(5))
+        self.assert_(time.time() - started < 1)
+
+    def test_poll(self):
+        self.connection.capabilities = ('IMAP4REV1',)
+        noops = []
+
+        def noop():
+            noops.append(None)
+            if len(noops) == 2:
+                self.connection.untagged_responses['RECENT'] = ['1']
+        self.connection.noop = noop
+        self.assert_(self.client.idle(5, 0.01))
+        self.assertEqual(len(noops), 2)
+
+
+class TestLazyMessage(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+
+        def uid(command, uids, items):
+            self.commands.append((uids, items))
+            data = []
+            for uid in uids.split(','):
+                if 'HEADER' in items:
+                    data.extend([('1 (UID %s RFC822.SIZE 2048 BODYSTRUCTURE '
+                                  '%s BODY[HEADER] {%d}' %
+                                  (uid, lazy_structure, len(lazy_headers)),
+                                  lazy_headers), ')'])
+                    continue
+                data.append('1 (UID %s' % uid)
+                for section in re.findall(r'BODY\.PEEK\[(\d+)\]', items):
+                    payload = {'1': 'hello', '2': 'cGRmZGF0YQ=='}[section]
+                    data.append((' BODY[%s] {%d}' % (section, len(payload)),
+                                 payload))
+                data.append(')')
+            return 'OK', data
+
+        self.sessionmock = Mock()
+        self.sessionmock.uid = uid
+
+    def test_parse_bodystructure(self):
+        items = parse_fetch(['1 (UID 7 BODYSTRUCTURE %s)' % lazy_structure])
+        self.assertEqual(parse_bodystructure(items['7']['BODYSTRUCTURE']),
+                         [('1', 'text/plain', None, '7bit'),
+                          ('2', 'application/pdf', 'b.pdf', 'base64')])
+        #Parts of attached messages, multipart or not
+        structure = parse_fetch(['1 (UID 7 BODYSTRUCTURE (%s'
+                                 '("MESSAGE" "RFC822" NIL NIL NIL "7BIT" '
+                                 '100 NIL %s 5 NIL NIL)'
+                                 '("MESSAGE" "RFC822" NIL NIL NIL "7BIT" '
+                                 '100 NIL ("TEXT" "HTML" NIL NIL NIL "7BIT" '
+                                 '4 1) 5) "MIXED" NIL))' %
+                                 (lazy_structure, lazy_structure)])
+        self.assertEqual(parse_bodystructure(structure['7']['BODYSTRUCTURE']),
+                         [('1.1', 'text/plain', None, '7bit'),
+                          ('1.2', 'application/pdf', 'b.pdf', 'base64'),
+                          ('2.1', 'text/plain', None, '7bit'),
+                          ('2.2', 'application/pdf', 'b.pdf', 'base64'),
+                          ('3.1', 'text/html', None, '7bit')])
+
+    def test_forwarded(self):
+        attached = MIMEMultipart()
+        attached['Subject'] = 'Original'
+        attached.attach(MIMEText('original text'))
+        attached.attach(MIMEText('<b>original</b>', 'html'))
+        pdf = MIMEApplication('pdfdata', 'pdf')
+        pdf.add_header('Content-Disposition', 'attachment',
+                       filename='a.pdf')
+        attached.attach(pdf)
+        forwarded = MIMEMultipart()
+        forwarded['From'] = 'sender@example.com'
+        forwarded['To'] = 'support@example.com'
+        forwarded['Subject'] = 'Fwd: Original'
+        forwarded.attach(MIMEText('see below'))
+        forwarded.attach(MIMEMessage(attached))
+        server = ImapServer()
+        mailbox = server.mailboxes['INBOX'] = Mailbox()
+        mailbox.add(forwarded.as_string().replace('\n', '\r\n'))
+        port = server.start()
+        extracted = []
+        try:
+            for lazy in (False, True):
+                client = ImapClient('127.0.0.1', 'user', 'password', port,
+                                    lazy=lazy)
+                message = client.all()[0]
+                extracted.append((message.text_bodies, message.html_bodies,
+                                  [(filename, ctype, fileobj.read())
+                                   for filename, ctype, fileobj
+                                   in message.attachments]))
+                client.logout()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(extracted[0][2],
+                         [('a.pdf', 'application/pdf', 'pdfdata')])
+        self.assertEqual(extracted[0][1], ['<b>original</b>'])
+        self.assertEqual(extracted[0], extracted[1])
+
+    def test_lazy_loading(self):
+        message = Message(self.sessionmock, '7', lazy=True)
+        self.assertEqual(message['subject'], 'Lazy')
+        self.assertEqual(message.sender, 'test@gmail.com')
+        self.assertEqual(message.size, 2048)
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(message.body, 'hello')
+        self.assertEqual(len(self.commands), 2)
+        filename, ctype, fileobj = message.attachments[0]
+        self.assertEqual((filename, ctype, fileobj.read()),
+                         ('b.pdf', 'application/pdf', 'pdfdata'))
+        self.assertEqual(self.commands[-1], ('7', '(UID BODY.PEEK[2])'))
+
+    def test_parts_batch(self):
+        batch = PartsBatch(self.sessionmock)
+        messages = [Message(self.sessionmock, uid, lazy=True)
+                    for uid in ['7', '9', '11', '13']]
+        del self.commands[:]
+        for message in messages:
+            message.parts_batch = batch
+        self.assert_(messages[0].parse_ahead())
+        self.assert_(messages[1].parse_ahead(attachments=False))
+        self.assert_(messages[2].parse_ahead())
+        self.assertEqual(messages[0].body, 'hello')
+        self.assertEqual(sorted(self.commands),
+                         [('7,11', '(UID BODY.PEEK[1] BODY.PEEK[2])'),
+                          ('9', '(UID BODY.PEEK[1])')])
+        self.assertEqual(messages[2].attachments[0][2].read(), 'pdfdata')
+        self.assertEqual(messages[1].body, 'hello')
+        self.assertEqual(len(self.commands), 2)
+        #Attachments that weren't asked for and messages that weren't
+        #parsed ahead are downloaded on their own
+        self.assertEqual(len(messages[1].attachments), 1)
+        self.assertEqual(messages[3].body, 'hello')
+        self.assertEqual(len(self.commands), 4)
+
+    def test_spooled_attachments(self):
+        data = 'x' * 1000 + '\xff' * 1000
+        encoded = base64.encodestring(data)
+        for source, encoding in [(encoded, 'base64'),
+                                 (encoded.replace('\n', '\n\n'), 'base64'),
+                                 (quopri.encodestring(data),
+                                  'quoted-printable'),
+                                 (data, '8bit')]:
+            fileobj = StringIO()
+            decode_payload_to(source, encoding, fileobj)
+            self.assertEqual(fileobj.getvalue(), data)
+        message = Message(self.sessionmock, '7', lazy=True, spool_size=4)
+        filename, ctype, fileobj = message.attachments[0]
+        self.assertEqual(fileobj.read(), 'pdfdata')
+        self.assert_(fileobj._rolled)
+
+
+class TestUnseen(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ImapServer()
+        mailbox = self.server.mailboxes['INBOX'] = Mailbox()
+        for num in range(3):
+            mailbox.add(make_message(num, 100, 1, 100))
+        self.port = self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def flags(self):
+        return [flags for uid, raw, flags
+                in self.server.mailboxes['INBOX'].messages]
+
+    def test_download(self):
+        for lazy in (False, True):
+            client = ImapClient('127.0.0.1', 'user', 'password', self.port,
+                                lazy=lazy)
+            msg_list = client.unseen()
+            for message in msg_list:
+                self.assert_(message.body)
+                self.assertEqual(len(message.attachments), 1)
+            msg_list.flush()
+            client.logout()
+            self.assert_(r'\Seen' not in set.union(*self.flags()))
+        client = ImapClient('127.0.0.1', 'user', 'password', self.port)
+        msg_list = client.unseen()
+        for message in msg_list:
+            message.mark_as_read()
+        msg_list.flush()
+        client.logout()
+        self.assertEqual([r'\Seen' in flags for flags in self.flags()],
+                         [True] * 3)
+
+
+class TestMime(unittest.TestCase):
+
+    raw = ('From: test@gmail.com\r\n'
+           'To: support@odesk.com\r\n'
+           'Subject: test\r\n'
+           'Content-Type: multipart/mixed; boundary="XX"\r\n'
+           '\r\n'
+           'preamble\r\n'
+           '--XX\r\n'
+           'Content-Type: multipart/alternative; boundary="XXY"\r\n'
+           '\r\n'
+           '--XXY\r\n'
+           '\r\n'
+           'plain\r\n'
+           '--XXY\r\n'
+           'Content-Type: text/html\r\n'
+           '\r\n'
+           '<b>html</b>\r\n'
+           '--XXY--\r\n'
+           '--XX\r\n'
+           'Content-Type: application/pdf; name="a.pdf"\r\n'
+           'Content-Transfer-Encoding: base64\r\n'
+           '\r\n'
+           'cGRmZGF0YQ==\r\n'
+           '--XX--\r\n'
+           'epilogue\r\n')
+
+    def test_split_headers(self):
+        self.assertEqual(split_headers('Subject: a\n\nbody'), 12)
+        self.assertEqual(split_headers('\r\nbody'), 2)
+        self.assertEqual(split_headers('Subject: a\n'), 11)
+
+    def test_walk_parts(self):
+        raw = self.raw
+        parts = [(headers.get_content_type(), raw[start:end])
+                 for headers, start, end in walk_parts(raw)]
+        self.assertEqual(parts, [('text/plain', 'plain'),
+                                 ('text/html', '<b>html</b>'),
+                                 ('application/pdf', 'cGRmZGF0YQ==')])
+
+    def test_message(self):
+        session = Mock()
+        session.uid.return_value = 'OK', [('1 (UID 1 BODY[] {%d}' %
+                                           len(self.raw), self.raw), ')']
+        message = Message(session, '1')
+        self.assertEqual(message['subject'], 'test')
+        self.assertEqual(message.body, 'plain')
+        self.assertEqual(message.html_bodies, ['<b>html</b>'])
+        filename, ctype, fileobj = message.attachments[0]
+        self.assertEqual((filename, fileobj.read()), ('a.pdf', 'pdfdata'))
+
+    def test_parser(self):
+        parser = ParserPool(2)
+        try:
+            for spool_size in [0, 4]:
+                message = Message(Mock(), '1', self.raw,
+                                  spool_size=spool_size, parser=parser)
+                self.assert_(message.parse_ahead())
+                self.assert_(not message.parse_ahead())
+                self.assertEqual(message['subject'], 'test')
+                self.assertEqual(message.body, 'plain')
+                self.assertEqual(message.html_bodies, ['<b>html</b>'])
+                filename, ctype, fileobj = message.attachments[0]
+                self.assertEqual((filename, ctype, fileobj.read()),
+                                 ('a.pdf', 'application/pdf', 'pdfdata'))
+                fileobj.close()
+            #Attachments spooled to files were taken over by messages
+            self.assertEqual(os.listdir(parser.directory), [])
+            #Messages that aren't parsed ahead are parsed in the process
+            message = Message(Mock(), '1', self.raw, spool_size=4,
+                              parser=parser)
+            self.assertEqual(message.body, 'plain')
+            self.assertEqual(os.listdir(parser.directory), [])
+            #Only messages whose parts are posted are parsed ahead
+            mapper = Mapper([{'url': '/', 'send_files': False,
+                              'msg_params': ['subject'],
+                              'conditions': {'subject': 'test'}},
+                             {'url': '/', 'conditions': {'subject': 'x'}}],
+                            'http://localhost:8000')
+            mapper.send = lambda request, options: 'ok'
+            messages = [Message(Mock(), '1', self.raw, spool_size=4,
+                                parser=parser),
+                        Message(Mock(), '2', self.raw.replace(
+                            'Subject: test', 'Subject: other'),
+                            spool_size=4, parser=parser)]
+            self.assertEqual(len(list(mapper.process(messages))), 1)
+            self.assert_(messages[0].parse_ahead())
+            self.assert_(messages[1].parse_ahead())
+            mapper = Mapper([{'url': '/'}], 'http://localhost:8000')
+            mapper.send = lambda request, options: 'ok'
+            message = Message(Mock(), '1', self.raw, spool_size=4,
+                              parser=parser)
+            self.assertEqual(len(list(mapper.process([message]))), 1)
+            self.assert_(not message.parse_ahead())
+        finally:
+            parser.close()
+        self.assertFalse(os.path.exists(parser.directory))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.store = CheckpointStore(':memory:')
+
+    def test_watermark(self):
+        checkpoint = self.store.checkpoint('INBOX', '1', save_every=2)
+        self.assertEqual(checkpoint.last_uid, 0)
+        for uid in ['3', '4', '7', '9']:
+            checkpoint.track(uid)
+        checkpoint.done('4')
+        checkpoint.done('7')
+        self.assertEqual(checkpoint.last_uid, 0)
+        checkpoint.done('3')
+        self.assertEqual(checkpoint.last_uid, 7)
+        self.assertEqual(self.store.get('INBOX'), ('1', 7))
+        checkpoint.done('9')
+        checkpoint.save()
+        self.assertEqual(self.store.get('INBOX'), ('1', 9))
+        #A message that failed is handed out again
+        for uid in ['10', '11']:
+            checkpoint.track(uid)
+        checkpoint.done('11')
+        checkpoint.reset()
+        self.assertFalse(checkpoint.track('10'))
+        checkpoint.done('10')
+        self.assertEqual(checkpoint.last_uid, 10)
+        #The message done after it isn't processed again
+        self.assert_(checkpoint.track('11'))
+        self.assertEqual(checkpoint.last_uid, 11)
+
+    def test_done_saved(self):
+        checkpoint = self.store.checkpoint('INBOX', '1')
+        for uid in ['3', '4', '5']:
+            checkpoint.track(uid)
+        checkpoint.done('4')
+        checkpoint.save()
+        self.assertEqual(self.store.get_done('INBOX'), set([4]))
+        #The next run skips the message done after the failed one
+        checkpoint = self.store.checkpoint('INBOX', '1')
+        self.assertFalse(checkpoint.track('3'))
+        self.assert_(checkpoint.track('4'))
+        checkpoint.done('3')
+        self.assertEqual(checkpoint.last_uid, 4)
+        checkpoint.save()
+        self.assertEqual(self.store.get('INBOX'), ('1', 4))
+        self.assertEqual(self.store.get_done('INBOX'), set())
+        self.store.set('INBOX', '1', 4, [6])
+        self.assertEqual(self.store.checkpoint('INBOX', '2')._done, set())
+
+    def test_inbox(self):
+        server = ImapServer()
+        mailbox = server.mailboxes['INBOX'] = Mailbox()
+        for num in range(3):
+            mailbox.add(make_message(num, 100))
+        port = server.start()
+        posted = []
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                if not posted:
+                    posted.append(None)
+                    return urllib2.URLError('refused')
+                posted.append(request.get_full_url())
+                return 'ok'
+
+        mapper = TestMapper([{'url': '/upload/'}], 'http://localhost:8000')
+        try:
+            for cycles in (2, 1):
+                client = ImapClient('127.0.0.1', 'user', 'password', port)
+                inbox = Inbox(client, 'INBOX', 'all', mapper, self.store)
+                for cycle in range(cycles):
+                    inbox.load_messages()
+                    list(inbox.process())
+                inbox.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        #The first message failed, only it was posted again
+        self.assertEqual(len(posted), 4)
+        self.assertEqual(self.store.get('user@127.0.0.1/INBOX'), ('1', 3))
+
+    def test_before_save(self):
+        checkpoint = self.store.checkpoint('INBOX', '1', save_every=1,
+                                           before_save=Mock())
+        checkpoint.track('1')
+        checkpoint.track('2')
+        #Messages done while the hook runs are left to the next save
+        checkpoint.before_save.side_effect = lambda: checkpoint.done('2')
+        checkpoint.done('1')
+        self.assertEqual(self.store.get('INBOX'), ('1', 1))
+        self.assertEqual(checkpoint.last_uid, 2)
+
+    def test_flags_stored_first(self):
+        server = ImapServer()
+        mailbox = server.mailboxes['INBOX'] = Mailbox()
+        for num in range(5):
+            mailbox.add(make_message(num, 100))
+        port = server.start()
+        saved = []
+        unread = []
+        store_set = self.store.set
+
+        def set(mailbox_name, uidvalidity, last_uid, done=()):
+            saved.append(last_uid)
+            unread.extend([uid for uid, raw, flags in mailbox.messages
+                           if uid <= last_uid and r'\Seen' not in flags])
+            store_set(mailbox_name, uidvalidity, last_uid, done)
+
+        self.store.set = set
+
+        class TestMapper(Mapper):
+
+            def send(self, request, options):
+                return 'ok'
+
+        mapper = TestMapper([{'url': '/upload/',
+                              'actions': ['mark_as_read']}],
+                            'http://localhost:8000')
+        try:
+            for prefetch in (0, 1):
+                client = ImapClient('127.0.0.1', 'user', 'password', port,
+                                    chunk_size=2)
+                inbox = Inbox(client, 'INBOX', 'unseen', mapper, self.store,
+                              prefetch=prefetch)
+                inbox.load_messages()
+                list(inbox.process())
+                inbox.close()
+                for message in mailbox.messages:
+                    message[2].clear()
+                self.store.set('user@127.0.0.1/INBOX', '1', 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+        #Saved after chunks too, with flags of saved messages stored.
+        #With prefetch, a chunk may be over before its messages are done
+        self.assertEqual(saved[:4], [2, 4, 5, 0])
+        self.assert_(len(saved) > 6)
+        self.assertEqual(saved.count(5), 2)
+        self.assertEqual(unread, [])
+
+    def test_uidvalidity_change(self):
+        self.store.set('INBOX', '1', 10)
+        self.assertEqual(self.store.checkpoint('INBOX', '1').last_uid, 10)
+        self.assertEqual(self.store.checkpoint('INBOX', '2').last_uid, 0)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(self.directory, max_attempts=3, retry_delay=10)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+
+    def test_delay(self):
+        for attempts, delay in [(1, 10), (2, 20), (3, 40), (10, 3600)]:
+            self.assert_(delay / 2.0 <= self.outbox.delay(attempts) <= delay)
+
+    def test_retry(self):
+        unavailable = urllib2.HTTPError('http://localhost/', 503,
+                                        'Unavailable', {}, None)
+        self.assert_(is_transient(unavailable))
+        self.assert_(not is_transient(urllib2.HTTPError(
+            'http://localhost/', 404, 'Not found', {}, None)))
+        self.outbox.add(urllib2.Request('http://localhost/a/', 'body',
+                                        {'X-Test': '1'}),
+                        {'auth': None}, unavailable)
+        self.outbox.add(urllib2.Request('http://localhost/b/',
+                                        iter(['multi', 'part'])),
+                        {'auth': {'url': 'http://localhost/login/'}},
+                        unavailable)
+        self.assertEqual(len(self.outbox), 2)
+        posted = []
+
+        def post(request, options):
+            posted.append((request.get_full_url(),
+                           ''.join(request.get_data()), options))
+            return unavailable
+
+        #Nothing is due yet
+        self.assertEqual(list(self.outbox.retry(post)), [])
+        later = time.time() + 3600
+        results = list(self.outbox.retry(post, later))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(posted),
+                         [('http://localhost/a/', 'body', {}),
+                          ('http://localhost/b/', 'multipart',
+                           {'auth': {'url': 'http://localhost/login/'}})])
+        #Given up after the third attempt
+        list(self.outbox.retry(post, later + 3600))
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(os.listdir(self.directory), ['outbox.db'])
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_prefetch(self):
+        produced = []
+
+        def produce():
+            for num in range(10):
+                produced.append(num)
+                yield num
+
+        items = prefetch(produce(), 2)
+        self.assertEqual(items.next(), 0)
+        time.sleep(0.1)
+        #One item taken, two waiting in the queue, one waiting for room
+        self.assertEqual(produced, range(4))
+        self.assertEqual(list(items), range(1, 10))
+
+    def test_stop(self):
+        items = prefetch(iter(range(100)), 1)
+        self.assertEqual(items.next(), 0)
+        items.close()
+        self.assertRaises(StopIteration, items.next)
+
+    def test_error(self):
+
+        def produce():
+            yield 1
+            raise ValueError('broken')
+
+        items = prefetch(produce(), 5)
+        self.assertEqual(items.next(), 1)
+        self.assertRaises(ValueError, items.next)
+
+
+class TestStats(unittest.TestCase):
+
+    def test_summary(self):
+        stats = Stats()
+        stats.incr('post.bytes', 100)
+        stats.incr('post.bytes', 50)
+        stats.timing('post', 0.5)
+        stats.timing('post', 1.5)
+        summary = stats.summary()
+        self.assertEqual(summary['counters'], {'post.bytes': 150})
+        self.assertEqual(summary['timings']['post'],
+                         {'count': 2, 'total': 2.0, 'max': 1.5,
+                          'average': 1.0})
+        self.assertEqual(metric_name('mailboxes', 'me@host/INBOX'),
+                         'mailboxes.me_host_INBOX')
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        exporter = StatsdExporter('127.0.0.1', server.getsockname()[1])
+        stats = Stats([exporter])
+        stats.incr('rules.0')
+        stats.timing('imap.UID_FETCH', 0.25)
+        self.assertEqual(server.recv(100), 'mailpost.rules.0:1|c')
+        self.assertEqual(server.recv(100),
+                         'mailpost.imap.UID_FETCH:250.000|ms')
+        exporter.close()
+        server.close()
+
+    def test_mapper(self):
+        stats = Stats()
+        message = {'from': 'test@gmail.com', 'subject': 'test'}
+        mapper = Mapper([{'url': '/odesk/', 'name': 'odesk',
+                          'conditions': {'from': '*@odesk.com'}},
+                         {'url': '/gmail/',
+                          'conditions': {'from': '*@gmail.com'}}],
+                        stats=stats)
+        mapper.map(message)
+        mapper.map({'from': 'test@example.com'})
+        self.assertEqual(stats.summary()['counters'],
+                         {'rules.1': 1, 'rules.unmatched': 1})
+        self.assertEqual(stats.summary()['timings']['match']['count'], 2)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'profile')
+            profiler = Profiler(filename)
+            profiler.start()
+            uid_set([str(uid) for uid in range(100)])
+            profiler.stop()
+            self.assert_(os.path.exists(filename))
+            report = StringIO()
+            profiler.report(report, 5)
+            self.assert_('uid_set' in report.getvalue())
+            #Threads started by the profiled code are profiled as well
+            profiler = Profiler(filename)
+            profiler.start()
+            results = Queue.Queue()
+            pool = WorkerPool(parse_fetch, 2, results)
+            for num in range(4):
+                pool.submit(num, ['%d (UID %d)' % (num, num)])
+            pool.close()
+            profiler.stop()
+            report = StringIO()
+            profiler.report(report, 50)
+            self.assert_('parse_fetch' in report.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def throttled(self, code, retry=None):
+        headers = Mock()
+        headers.get.return_value = retry
+        return urllib2.HTTPError('http://localhost/', code, 'Slow down',
+                                 headers, None)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(20, 2)
+        started = time.time()
+        for num in range(6):
+            bucket.acquire()
+        #2 at once, the next 4 at 20 per second
+        self.assert_(0.15 < time.time() - started < 0.4)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(self.throttled(503, '120')), 120)
+        self.assertEqual(retry_after(self.throttled(503)), None)
+        date = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assert_(55 < retry_after(self.throttled(429, date)) <= 60)
+
+    def test_slow_down(self):
+        limiter = Limiter(rate=10, max_in_flight=1, max_pause=30)
+        limiter.acquire()
+        self.assert_(not limiter.slots.acquire(False))
+        self.assert_(limiter.release(self.throttled(429)))
+        self.assertEqual(limiter.bucket.rate, 5)
+        self.assert_(0.9 < limiter.paused_until - time.time() <= 1)
+        limiter.release(self.throttled(503, '3600'))
+        self.assert_(29 < limiter.paused_until - time.time() <= 30)
+        self.assertEqual(limiter.bucket.rate, 2.5)
+        limiter.paused_until = 0
+        limiter.release(self.throttled(404))
+        self.assertEqual(limiter.bucket.rate, 2.5)
+        limiter.release('ok')
+        self.assertEqual((limiter.bucket.rate, limiter.backoff), (3.5, 0))
+
+    def test_unexpected_error(self):
+        mapper = Mapper([{'url': '/', 'max_in_flight': 1}],
+                        'http://localhost:8000')
+        opener = mapper.opener = Mock()
+        opener.open.side_effect = IOError('cookies not saved')
+        url, rule = mapper.map({})
+        for num in range(2):
+            self.assertRaises(IOError, mapper.post,
+                              urllib2.Request(url, 'data'), rule)
+        #The slot was released after every failure
+        self.assert_(rule.limiter.slots.acquire(False))
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        connection, reused = pool.get('http', 'localhost:8000')
+        self.assert_(not reused)
+        pool.put('http', 'localhost:8000', connection)
+        self.assertEqual(pool.get('http', 'localhost:8000'),
+                         (connection, True))
+        other, reused = pool.get('https', 'localhost:8000')
+        self.assert_(other is not connection and not reused)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0)
+        connection, reused = pool.get('http', 'localhost:8000')
+        pool.put('http', 'localhost:8000', connection)
+        other, reused = pool.get('http', 'localhost:8000')
+        self.assert_(other is not connection and not reused)
+
+
+class TestSession(unittest.TestCase):
+
+    auth_data = {'url': '/login/', 'form': {'username': 'john',
+                                            'password': 'pass'}}
+
+    def setUp(self):
+        self.opened = []
+        self.responses = []
+
+        def open(request):
+            if isinstance(request, str):
+                url = request
+            else:
+                url = request.get_full_url()
+            self.opened.append(url)
+            if self.responses and url.endswith('/upload_email/'):
+                return self.responses.pop(0)
+            return urllib.addinfourl(StringIO('ok'), {}, url, 200)
+
+        self.open = open
+
+    def get_session(self, cache):
+        session = cache.get(self.auth_data, 'http://localhost:8000')
+        session.opener = Mock()
+        session.opener.open = self.open
+        return session
+
+    def test_login_once(self):
+        cache = SessionCache()
+        session = self.get_session(cache)
+        self.assert_(cache.get(self.auth_data, 'http://localhost:8000')
+                     is session)
+        request = urllib2.Request('http://localhost:8000/upload_email/')
+        for num in range(3):
+            self.assertEqual(session.open(request).read(), 'ok')
+        self.assertEqual(self.opened,
+                         ['http://localhost:8000/login/'] * 2 +
+                         ['http://localhost:8000/upload_email/'] * 3)
+
+    def test_login_again(self):
+        session = self.get_session(SessionCache())
+        request = urllib2.Request('http://localhost:8000/upload_email/')
+        session.open(request)
+        del self.opened[:]
+        self.responses.append(urllib.addinfourl(StringIO('login form'), {},
+                                  'http://localhost:8000/login/?next=/', 200))
+        self.assertEqual(session.open(request).read(), 'ok')
+        self.assertEqual(self.opened,
+                         ['http://localhost:8000/upload_email/'] +
+                         ['http://localhost:8000/login/'] * 2 +
+                         ['http://localhost:8000/upload_email/'])
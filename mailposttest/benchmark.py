@@ -0,0 +1,563 @@
+"""
+Benchmark of the whole fetch -> match -> post pipeline.
+
+Synthetic mailboxes are served by an in-process IMAP server and messages
+are posted to an in-process HTTP sink, which answers after a configurable
+latency. The real Handler.process is run against them and messages/sec,
+latency of posts, IMAP round-trips and peak RSS are reported.
+
+    python -m mailposttest.benchmark --messages 1000 --latency 0.05
+
+A package that maps incoming email to HTTP requests
+Mailpost version 0.1
+(C) 2010 oDesk www.oDesk.com
+"""
+
+
+
+import BaseHTTPServer
+import SocketServer
+import email
+import random
+import re
+import resource
+import sys
+import threading
+import time
+from optparse import OptionParser
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from mailpost.handler import Handler, Mapper
+from mailpost.profiling import Profiler
+
+#Domains of senders of synthetic messages, each one has its own rule
+SENDER_DOMAINS = 10
+LITERAL_EXPR = re.compile(r'\{(\d+)\}$')
+
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def quote_params(params):
+    if not params:
+        return 'NIL'
+    return '(%s)' % ' '.join(['%s %s' % (quote(name.upper()), quote(value))
+                              for name, value in params])
+
+
+def bodystructure(msg):
+    """
+    BODYSTRUCTURE of a parsed message, good enough for lazy messages
+    """
+    if msg.get_content_type() == 'message/rfc822':
+        attached = msg.get_payload()[0]
+        raw = attached.as_string()
+        encoding = msg.get('Content-Transfer-Encoding', '7bit').upper()
+        return '(%s %s %s NIL NIL %s %d NIL %s %d NIL NIL)' % (
+            quote('MESSAGE'), quote('RFC822'),
+            quote_params(msg.get_params()[1:]), quote(encoding), len(raw),
+            bodystructure(attached), raw.count('\n'))
+    if msg.is_multipart():
+        parts = ''.join([bodystructure(part) for part in msg.get_payload()])
+        return '(%s %s %s NIL NIL NIL)' % (
+            parts, quote(msg.get_content_subtype().upper()),
+            quote_params(msg.get_params()[1:]))
+    payload = msg.get_payload()
+    encoding = msg.get('Content-Transfer-Encoding', '7bit').upper()
+    fields = '%s %s %s NIL NIL %s %d' % (
+        quote(msg.get_content_maintype().upper()),
+        quote(msg.get_content_subtype().upper()),
+        quote_params(msg.get_params()[1:]), quote(encoding), len(payload))
+    if msg.get_content_maintype() == 'text':
+        fields += ' %d' % payload.count('\n')
+    disposition = 'NIL'
+    if msg.get('Content-Disposition'):
+        params = msg.get_params(header='content-disposition')
+        disposition = '(%s %s)' % (quote(params[0][0].upper()),
+                                   quote_params(params[1:]))
+    return '(%s NIL %s NIL NIL)' % (fields, disposition)
+
+
+class Mailbox(object):
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        #[uid, raw message, set of flags]
+        self.messages = []
+        self.next_uid = 1
+
+    def add(self, raw, flags=()):
+        self.messages.append([self.next_uid, raw, set(flags)])
+        self.next_uid += 1
+
+
+class ImapRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    The subset of IMAP4rev1 used by ImapClient, without IDLE
+    """
+    #Responses are written at once, small writes would wait for delayed ACKs
+    wbufsize = -1
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        self.selected = None
+        self.send('* OK benchmark server ready')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip('\r\n')
+            literal = LITERAL_EXPR.search(line)
+            if literal:
+                #Only LOGIN arguments may be sent as literals
+                self.send('+ go on')
+                self.wfile.flush()
+                line = line[:literal.start()] + \
+                    quote(self.rfile.read(int(literal.group(1)))) + \
+                    self.rfile.readline().rstrip('\r\n')
+            tag, command = line.split(' ', 1)
+            command, args = (command.split(' ', 1) + [''])[:2]
+            command = command.upper()
+            if command == 'UID':
+                command, args = (args.split(' ', 1) + [''])[:2]
+                command = 'UID_' + command.upper()
+            self.server.count(command)
+            method = getattr(self, 'do_' + command, None)
+            if method is None:
+                self.send('%s BAD unknown command' % tag)
+            elif method(tag, args) is False:
+                return
+            self.wfile.flush()
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY IMAP4rev1')
+        self.send('%s OK done' % tag)
+
+    def do_LOGIN(self, tag, args):
+        self.send('%s OK logged in' % tag)
+
+    def do_NOOP(self, tag, args):
+        self.send('%s OK done' % tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE')
+        self.send('%s OK bye' % tag)
+        return False
+
+    def do_SELECT(self, tag, args):
+        mailbox = self.server.mailboxes.get(args.strip('"'))
+        if mailbox is None:
+            self.send('%s NO no such mailbox' % tag)
+            return
+        self.selected = mailbox
+        self.send('* %d EXISTS' % len(mailbox.messages))
+        self.send('* OK [UIDVALIDITY %d] ok' % mailbox.uidvalidity)
+        self.send('%s OK [READ-WRITE] selected' % tag)
+
+    def do_CLOSE(self, tag, args):
+        self.selected = None
+        self.send('%s OK closed' % tag)
+
+    def do_EXPUNGE(self, tag, args):
+        kept = []
+        for num, message in enumerate(self.selected.messages):
+            if r'\Deleted' in message[2]:
+                self.send('* %d EXPUNGE' % (num + 1 - len(kept)))
+            else:
+                kept.append(message)
+        self.selected.messages[:] = kept
+        self.send('%s OK expunged' % tag)
+
+    def find(self, uids):
+        messages = self.selected.messages
+        last = messages and messages[-1][0] or 0
+        found = []
+        for item in uids.split(','):
+            bounds = [value == '*' and last or int(value)
+                      for value in item.split(':')]
+            low, high = min(bounds), max(bounds)
+            found.extend([message for message in messages
+                          if low <= message[0] <= high])
+        return found
+
+    def do_UID_SEARCH(self, tag, args):
+        tokens = args.replace('(', ' ').replace(')', ' ').upper().split()
+        if tokens[0] == 'CHARSET':
+            tokens = tokens[2:]
+        messages = self.selected.messages
+        if tokens[0] == 'UID':
+            messages = self.find(tokens[1])
+            tokens = tokens[2:]
+        if tokens == ['UNSEEN']:
+            messages = [message for message in messages
+                        if r'\Seen' not in message[2]]
+        elif tokens == ['NOT', 'DELETED']:
+            messages = [message for message in messages
+                        if r'\Deleted' not in message[2]]
+        elif tokens == ['DELETED']:
+            messages = [message for message in messages
+                        if r'\Deleted' in message[2]]
+        self.send('* SEARCH %s' % ' '.join([str(message[0])
+                                            for message in messages]))
+        self.send('%s OK search done' % tag)
+
+    def do_UID_STORE(self, tag, args):
+        uids, mode, flags = args.split(' ', 2)
+        #imaplib sends flags starting with a backslash quoted
+        flags = [flag.strip('"').replace('\\\\', '\\')
+                 for flag in flags.strip('()').split()]
+        for message in self.find(uids):
+            if mode.startswith('+'):
+                message[2].update(flags)
+            else:
+                message[2].difference_update(flags)
+        self.send('%s OK store done' % tag)
+
+    def do_UID_FETCH(self, tag, args):
+        uids, items = args.split(' ', 1)
+        items = items.strip('()').upper().split()
+        messages = self.selected.messages
+        for message in self.find(uids):
+            uid, raw, flags = message
+            attributes = ['UID %d' % uid]
+            literals = []
+            parsed = None
+            #Like real servers, only PEEK fetches keep a message unseen
+            if [item for item in items
+                if item == 'RFC822' or item.startswith('BODY[')]:
+                flags.add(r'\Seen')
+            for item in items:
+                if item == 'RFC822.SIZE':
+                    attributes.append('RFC822.SIZE %d' % len(raw))
+                elif item == 'FLAGS':
+                    attributes.append('FLAGS (%s)' % ' '.join(flags))
+                elif item == 'BODYSTRUCTURE':
+                    parsed = parsed or email.message_from_string(raw)
+                    attributes.append('BODYSTRUCTURE ' +
+                                      bodystructure(parsed))
+                elif item == 'RFC822':
+                    literals.append(('RFC822', raw))
+                elif item in ('BODY[]', 'BODY.PEEK[]'):
+                    literals.append(('BODY[]', raw))
+                elif item == 'BODY.PEEK[HEADER]':
+                    literals.append(('BODY[HEADER]',
+                                     raw.split('\r\n\r\n', 1)[0] +
+                                     '\r\n\r\n'))
+                elif item.startswith('BODY.PEEK['):
+                    section = item[len('BODY.PEEK['):-1]
+                    part = parsed = parsed or email.message_from_string(raw)
+                    for num in section.split('.'):
+                        if part.get_content_type() == 'message/rfc822':
+                            part = part.get_payload()[0]
+                        if part.is_multipart():
+                            part = part.get_payload()[int(num) - 1]
+                    literals.append(('BODY[%s]' % section,
+                                     part.get_payload()))
+            line = '* %d FETCH (%s' % (messages.index(message) + 1,
+                                       ' '.join(attributes))
+            for name, data in literals:
+                self.wfile.write('%s %s {%d}\r\n' % (line, name, len(data)))
+                self.wfile.write(data)
+                line = ''
+            self.send(line + ')')
+        self.send('%s OK fetch done' % tag)
+
+
+class ImapServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    IMAP server with mailboxes kept in memory, counting received commands
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        SocketServer.TCPServer.__init__(self, address, ImapRequestHandler)
+        self.mailboxes = {}
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def count(self, command):
+        self._lock.acquire()
+        try:
+            self.commands[command] = self.commands.get(command, 0) + 1
+        finally:
+            self._lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self.server_address[1]
+
+
+class SinkRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #Response is written at once, small writes would wait for delayed ACKs
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        received = 0
+        while received < length:
+            block = self.rfile.read(min(length - received, 64 * 1024))
+            if not block:
+                break
+            received += len(block)
+        self.server.count(received)
+        time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    do_GET = do_POST
+
+
+class HttpSink(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server answering every request with 'ok' after `latency` seconds
+    on average
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, latency=0, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SinkRequestHandler)
+        self.latency = latency
+        self.requests = 0
+        self.received = 0
+        self._lock = threading.Lock()
+
+    def count(self, received):
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            self.received += received
+        finally:
+            self._lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return 'http://%s:%d' % self.server_address
+
+
+def make_message(num, body_size, attachments=0, attachment_size=0,
+                 rand=random):
+    """
+    Synthetic message from one of SENDER_DOMAINS with CRLF line endings
+    """
+    msg = MIMEMultipart()
+    msg['From'] = 'Sender %d <sender%d@domain%d.example.com>' % (
+        num, num, num % SENDER_DOMAINS)
+    msg['To'] = 'Support <support@example.com>'
+    msg['Subject'] = 'Benchmark message %d' % num
+    msg['Message-ID'] = '<%d@benchmark.example.com>' % num
+    line = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n'
+    msg.attach(MIMEText(line * max(1, body_size / len(line))))
+    for part in range(attachments):
+        data = ''.join([chr(rand.randint(0, 255))
+                        for byte in range(min(attachment_size, 1024))])
+        data = (data * (attachment_size / len(data) + 1))[:attachment_size]
+        attachment = MIMEApplication(data)
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename='file%d-%d.bin' % (num, part))
+        msg.attach(attachment)
+    return msg.as_string().replace('\n', '\r\n')
+
+
+def fill_mailboxes(server, options):
+    rand = random.Random(options.seed)
+    num = 0
+    for box in range(options.mailboxes):
+        mailbox = server.mailboxes['INBOX%d' % box] = Mailbox()
+        for message in range(options.messages):
+            attachments = 0
+            if rand.random() < options.attachment_ratio:
+                attachments = options.attachments
+            mailbox.add(make_message(num, options.body_size, attachments,
+                                     options.attachment_size, rand))
+            num += 1
+
+
+class TimingMapper(Mapper):
+    """
+    Mapper recording how long every post took
+    """
+    latencies = None
+
+    def post(self, request, options):
+        started = time.time()
+        try:
+            return Mapper.post(self, request, options)
+        finally:
+            self.latencies.append(time.time() - started)
+
+
+class BenchmarkHandler(Handler):
+
+    def __init__(self, config, latencies):
+        Handler.__init__(self, config)
+        self.latencies = latencies
+
+    def get_mapper(self, rules, base_url=None):
+        mapper = TimingMapper(rules, base_url, self.workers,
+                              self.connections, self.sessions, self.outbox,
+                              self.stats, self.limits)
+        mapper.latencies = self.latencies
+        return mapper
+
+
+def get_config(port, base_url, options):
+    rules = [{'url': '/domain%d/' % num,
+              'conditions': {'sender': '*@domain%d.example.com' % num}}
+             for num in range(SENDER_DOMAINS)]
+    rules.append({'url': '/other/'})
+    for rule in rules:
+        rule['batch_size'] = options.batch_size
+        rule['format'] = options.format
+    return {
+        'backend': 'imap',
+        'host': '127.0.0.1',
+        'port': port,
+        'username': 'benchmark',
+        'password': 'benchmark',
+        'inboxes': sorted(['INBOX%d' % num
+                           for num in range(options.mailboxes)]),
+        'chunk_size': options.chunk_size,
+        'chunk_bytes': options.chunk_bytes,
+        'lazy': options.lazy,
+        'prefetch': options.prefetch,
+        'parse_processes': options.parse_processes,
+        'workers': options.workers,
+        'base_url': base_url,
+        'rules': rules,
+    }
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in Mb (ru_maxrss is in Kb on
+    Linux, in bytes on Mac OS X)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.0
+
+
+def run(server, sink, base_url, options):
+    latencies = []
+    server.commands.clear()
+    sink.requests = sink.received = 0
+    handler = BenchmarkHandler(get_config(server.server_address[1],
+                                          base_url, options), latencies)
+    profiler = None
+    if options.profile:
+        profiler = Profiler(options.profile, options.profile_memory)
+        profiler.start()
+    started = time.time()
+    results = list(handler.process())
+    elapsed = time.time() - started
+    if profiler:
+        profiler.stop()
+    handler.connections.close()
+    errors = len([result for url, result in results
+                  if isinstance(result, Exception)])
+    print 'messages:      %d (%d errors)' % (len(results), errors)
+    print 'elapsed:       %.2fs' % elapsed
+    print 'messages/sec:  %.1f' % (len(results) / elapsed)
+    print 'post latency:  p50 %.1fms, p99 %.1fms' % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+    commands = ', '.join(['%s %d' % item
+                          for item in sorted(server.commands.items())])
+    print 'IMAP commands: %d (%s)' % (sum(server.commands.values()), commands)
+    print 'HTTP requests: %d, %.1fMb posted' % (sink.requests,
+                                                sink.received / 1048576.0)
+    print 'peak RSS:      %.1fMb' % peak_rss()
+    if profiler:
+        profiler.report()
+
+
+def option_parser():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--mailboxes', type='int', default=1,
+                      help='number of mailboxes [%default]')
+    parser.add_option('--messages', type='int', default=500,
+                      help='messages per mailbox [%default]')
+    parser.add_option('--body-size', type='int', default=2048,
+                      help='bytes of text body [%default]')
+    parser.add_option('--attachment-ratio', type='float', default=0.3,
+                      help='share of messages with attachments [%default]')
+    parser.add_option('--attachments', type='int', default=1,
+                      help='attachments of such messages [%default]')
+    parser.add_option('--attachment-size', type='int', default=256 * 1024,
+                      help='bytes of every attachment [%default]')
+    parser.add_option('--latency', type='float', default=0.02,
+                      help='average seconds the sink takes to answer '
+                           '[%default]')
+    parser.add_option('--workers', type='int', default=0,
+                      help="'workers' option [%default]")
+    parser.add_option('--batch-size', type='int', default=0,
+                      help="'batch_size' option of rules [%default]")
+    parser.add_option('--format', default='multipart',
+                      help="'format' option of rules [%default]")
+    parser.add_option('--chunk-size', type='int', default=200,
+                      help="'chunk_size' option [%default]")
+    parser.add_option('--chunk-bytes', type='int', default=32 * 1024 * 1024,
+                      help="'chunk_bytes' option [%default]")
+    parser.add_option('--lazy', action='store_true', default=False,
+                      help="'lazy' option")
+    parser.add_option('--prefetch', type='int', default=0,
+                      help="'prefetch' option [%default]")
+    parser.add_option('--parse-processes', type='int', default=0,
+                      help="'parse_processes' option [%default]")
+    parser.add_option('--profile', metavar='FILE',
+                      help='profile runs with cProfile, save the results '
+                           'to FILE')
+    parser.add_option('--profile-memory', action='store_true',
+                      default=False,
+                      help='with --profile, trace allocations as well')
+    parser.add_option('--repeat', type='int', default=1,
+                      help='number of runs [%default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of synthetic messages [%default]')
+    return parser
+
+
+def main():
+    options, args = option_parser().parse_args()
+    server = ImapServer()
+    server.start()
+    fill_mailboxes(server, options)
+    sink = HttpSink(options.latency)
+    base_url = sink.start()
+    print 'mailboxes filled, RSS %.1fMb' % peak_rss()
+    for num in range(options.repeat):
+        print '--- run %d' % (num + 1)
+        run(server, sink, base_url, options)
+    sink.shutdown()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()